@@ -0,0 +1,703 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Micro-benchmarks for seq2seq.py
+
+    python bench.py attention --hidden_size 256 --batch_size 8 --src_len 15
+
+and the end-to-end suite on the bundled fren data, with fixed seeds and threads,
+whose JSON results can be checked against an earlier run:
+
+    python bench.py suite --out baseline.json
+    python bench.py suite --out current.json --baseline baseline.json
+"""
+
+
+from __future__ import unicode_literals, print_function, division
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+
+import seq2seq
+
+
+def time_it(fn, repeat, warmup=3):
+    """runs fn() warmup + repeat times and returns the mean seconds per call
+    """
+    for _ in range(warmup):
+        fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+######################################################################
+
+def attention_loop(layer, hidden, encoder_outputs, src_mask=None):
+    """the original AttentionLayer.forward: one score() call per (batch, position) cell
+    """
+    max_len = encoder_outputs.size(0)
+    this_batch_size = encoder_outputs.size(1)
+
+    attn_energies = torch.zeros(this_batch_size, max_len)
+
+    for b in range(this_batch_size):
+        for i in range(max_len):
+            h = hidden[:, b].squeeze(0)
+            attn_energies[b, i] = layer.score(h, encoder_outputs[i, b])
+
+    if src_mask is not None:
+        attn_energies = attn_energies.masked_fill(~src_mask, float('-inf'))
+
+    return F.softmax(attn_energies, dim=1).unsqueeze(1)
+
+
+def random_length(max_length):
+    return int(torch.randint(1, max_length + 1, (1,)).item())
+
+
+def bench_attention(args):
+    torch.manual_seed(args.seed)
+    lengths = sorted([random_length(args.src_len) for _ in range(args.batch_size)], reverse=True)
+    lengths[0] = args.src_len
+    src_mask = seq2seq.sequence_mask(lengths, args.src_len)
+
+    for method in ('dot', 'general', 'concat'):
+        layer = seq2seq.AttentionLayer(method, args.hidden_size).to(seq2seq.device)
+        hidden = torch.randn(1, args.batch_size, args.hidden_size, device=seq2seq.device)
+        encoder_outputs = torch.randn(args.src_len, args.batch_size, args.hidden_size, device=seq2seq.device)
+
+        with torch.no_grad():
+            memory = layer.precompute(encoder_outputs, src_mask)
+            old = attention_loop(layer, hidden, encoder_outputs, src_mask)
+            max_diff = 0.0
+            for new in (layer(hidden, encoder_outputs, src_mask), layer(hidden, memory=memory)):
+                max_diff = max(max_diff, (old - new).abs().max().item())
+                if not torch.allclose(old, new, atol=args.atol):
+                    raise AssertionError('%s: batched attention differs from loop (max abs diff %g)' % (method, max_diff))
+
+            old_t = time_it(lambda: attention_loop(layer, hidden, encoder_outputs, src_mask), args.repeat)
+            new_t = time_it(lambda: layer(hidden, encoder_outputs, src_mask), args.repeat)
+            # a decoder step once the memory is built: the key projection is not repeated
+            cached_t = time_it(lambda: layer(hidden, memory=memory), args.repeat)
+
+        logging.info('attention %-7s loop:%.3fms batched:%.3fms speedup:%.1fx per step with memory:%.3fms '
+                     'max_abs_diff:%.2e',
+                     method, old_t * 1e3, new_t * 1e3, old_t / new_t, cached_t * 1e3, max_diff)
+
+
+######################################################################
+
+def saved_activation_bytes(fn):
+    """bytes of the tensors autograd saves for backward while fn() runs
+    """
+    total = [0]
+
+    def pack(tensor):
+        total[0] += tensor.numel() * tensor.element_size()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        fn()
+    return total[0]
+
+
+def check_lstm(lstm, inputs, lengths, atol):
+    """runs lstm and an nn.LSTM with the same weights on a variable-length batch from a random
+    state, given both as lengths and as a PackedSequence, and raises AssertionError unless the
+    outputs and the final (h, c) match. returns the max abs difference
+    """
+    num_directions = len(lstm.cells)
+    reference = nn.LSTM(lstm.input_size, lstm.hidden_size, bidirectional=lstm.bidirectional)
+    with torch.no_grad():
+        for cell, suffix in zip(lstm.cells, ('_l0', '_l0_reverse')):
+            getattr(reference, 'weight_ih' + suffix).copy_(cell.weight_ih)
+            getattr(reference, 'weight_hh' + suffix).copy_(cell.weight_hh)
+            getattr(reference, 'bias_ih' + suffix).copy_(cell.bias)
+            getattr(reference, 'bias_hh' + suffix).zero_()
+
+    state = (torch.randn(num_directions, inputs.size(1), lstm.hidden_size),
+             torch.randn(num_directions, inputs.size(1), lstm.hidden_size))
+    with torch.no_grad():
+        expected_packed, expected_state = reference(pack_padded_sequence(inputs, lengths), state)
+        expected, _ = pad_packed_sequence(expected_packed, total_length=inputs.size(0))
+        ours_packed, ours_packed_state = lstm(pack_padded_sequence(inputs, lengths), state=state)
+        ours_unpacked, _ = pad_packed_sequence(ours_packed, total_length=inputs.size(0))
+        results = [('lengths', lstm(inputs, lengths, state)), ('packed', (ours_unpacked, ours_packed_state))]
+
+    max_diff = 0.0
+    for name, (outputs, (h, c)) in results:
+        for what, ours, theirs in (('outputs', outputs, expected), ('h', h, expected_state[0]),
+                                   ('c', c, expected_state[1])):
+            diff = (ours - theirs).abs().max().item()
+            max_diff = max(max_diff, diff)
+            if not torch.allclose(ours, theirs, atol=atol):
+                raise AssertionError('LSTM (%s input) %s differs from nn.LSTM (max abs diff %g)' % (name, what, diff))
+    return max_diff
+
+
+def bench_rnn(args):
+    torch.manual_seed(args.seed)
+    for hidden_size in args.hidden_sizes:
+        for batch_size in args.batch_sizes:
+            inputs = torch.randn(args.seq_len, batch_size, hidden_size)
+            lengths = sorted([random_length(args.seq_len) for _ in range(batch_size)], reverse=True)
+            lengths[0] = args.seq_len
+            n_tokens = sum(lengths)
+
+            def ours(lstm):
+                return lambda: lstm(inputs, lengths)[0].sum().backward()
+
+            def builtin(rnn):
+                return lambda: rnn(pack_padded_sequence(inputs, lengths))[0].data.sum().backward()
+
+            lstm = seq2seq.LSTM(hidden_size, hidden_size, bidirectional=args.bidirectional)
+            for scripted in (False, True):
+                seq2seq.script_lstm(scripted)
+                max_diff = check_lstm(lstm, inputs, lengths, args.atol)
+                logging.info('rnn hidden:%-4d batch:%-3d LSTM%s matches nn.LSTM (max_abs_diff:%.2e)',
+                             hidden_size, batch_size, ' scripted' if scripted else '', max_diff)
+            candidates = [
+                ('LSTM', ours(lstm), False),
+                ('LSTM scripted', ours(lstm), True),
+                ('nn.LSTM', builtin(nn.LSTM(hidden_size, hidden_size, bidirectional=args.bidirectional)), False),
+                ('nn.GRU', builtin(nn.GRU(hidden_size, hidden_size, bidirectional=args.bidirectional)), False),
+            ]
+            for name, step, scripted in candidates:
+                seq2seq.script_lstm(scripted)
+                step_t = time_it(step, args.repeat)
+                memory = saved_activation_bytes(step)
+                logging.info('rnn hidden:%-4d batch:%-3d %-14s step:%.2fms tokens/sec:%.0f saved_for_backward:%.1fMB',
+                             hidden_size, batch_size, name, step_t * 1e3, n_tokens / step_t, memory / 2 ** 20)
+    seq2seq.script_lstm(False)
+
+
+def zipf_targets(vocab_size, n_tokens):
+    """target indices drawn from a Zipf distribution over a frequency-sorted vocab
+    """
+    probs = 1.0 / torch.arange(1, vocab_size + 1, dtype=torch.double)
+    return torch.multinomial(probs, n_tokens, replacement=True)
+
+
+def bench_softmax(args):
+    torch.manual_seed(args.seed)
+    n_tokens = args.batch_size * args.tgt_len
+    for vocab_size in args.vocab_sizes:
+        targets = zipf_targets(vocab_size, n_tokens)
+        cutoffs = seq2seq.adaptive_cutoffs(torch.bincount(targets, minlength=vocab_size))
+        features = torch.randn(n_tokens, args.hidden_size, requires_grad=True)
+
+        dense = nn.Linear(args.hidden_size, vocab_size)
+        adaptive = nn.AdaptiveLogSoftmaxWithLoss(args.hidden_size, vocab_size, cutoffs)
+        candidates = [
+            ('dense', dense, lambda: F.cross_entropy(dense(features), targets).backward(),
+             lambda: dense(features).topk(args.k)),
+            ('adaptive', adaptive, lambda: adaptive(features, targets).loss.backward(),
+             lambda: adaptive.log_prob(features).topk(args.k)),
+        ]
+        for name, head, train_step, decode_step in candidates:
+            train_t = time_it(train_step, args.repeat)
+            memory = saved_activation_bytes(train_step)
+            with torch.no_grad():
+                decode_t = time_it(decode_step, args.repeat)
+            n_params = sum(param.numel() for param in head.parameters())
+            logging.info('softmax vocab:%-6d %-8s train step:%.2fms tokens/sec:%.0f saved_for_backward:%.1fMB '
+                         'params:%.1fM exact top-%d:%.2fms',
+                         vocab_size, name, train_t * 1e3, n_tokens / train_t, memory / 2 ** 20,
+                         n_params / 1e6, args.k, decode_t * 1e3)
+        logging.info('softmax vocab:%-6d adaptive cutoffs: %s', vocab_size, cutoffs)
+
+
+def random_batch(batch_size, max_length, vocab_size):
+    """a (max_length x batch) batch of random word indices, padded after each length, longest first
+    """
+    lengths = sorted([random_length(max_length) for _ in range(batch_size)], reverse=True)
+    lengths[0] = max_length
+    batch = torch.randint(len(seq2seq.SPECIAL_TOKENS), vocab_size, (max_length, batch_size))
+    return batch.masked_fill(~seq2seq.sequence_mask(lengths, max_length).t(), seq2seq.PAD_index), lengths
+
+
+def bench_precision(args):
+    torch.manual_seed(args.seed)
+    for hidden_size in args.hidden_sizes:
+        encoder = seq2seq.EncoderRNN(args.vocab_size, hidden_size)
+        cutoffs = None
+        if args.output_head == 'adaptive':
+            cutoffs = seq2seq.adaptive_cutoffs(torch.bincount(zipf_targets(args.vocab_size, 100000),
+                                                              minlength=args.vocab_size))
+        decoder = seq2seq.AttnDecoderRNN(args.attn_model, hidden_size, args.vocab_size, cutoffs=cutoffs)
+        optimizer = torch.optim.Adam(list(encoder.parameters()) + list(decoder.parameters()))
+        src, src_lengths = random_batch(args.batch_size, seq2seq.MAX_LENGTH, args.vocab_size)
+        tgt, tgt_lengths = random_batch(args.batch_size, seq2seq.MAX_LENGTH, args.vocab_size)
+        src_mask = seq2seq.sequence_mask(src_lengths, src.size(0))
+
+        def decode():
+            encoder_outputs, encoder_hidden = encoder(src, src_lengths)
+            seq2seq.greedy_decode(decoder, encoder_outputs, encoder_hidden, src_mask)
+
+        for precision in seq2seq.PRECISIONS:
+            train_t = time_it(lambda: seq2seq.train(src, src_lengths, tgt, tgt_lengths, encoder, decoder, optimizer,
+                                                    teacher_force_ratio=1.0, precision=precision), args.repeat)
+            encoder.eval()
+            decoder.eval()
+            with torch.no_grad(), seq2seq.autocast(precision):
+                decode_t = time_it(decode, args.repeat)
+            logging.info('precision hidden:%-4d %s %s head train step:%.2fms greedy decode:%.2fms (batch %d)',
+                         hidden_size, precision, args.output_head, train_t * 1e3, decode_t * 1e3, args.batch_size)
+
+    if args.checkpoint is None:
+        return
+    encoder, decoder, src_vocab, tgt_vocab = seq2seq.load_model(args.checkpoint)
+    dev_pairs = seq2seq.split_lines(args.dev_file)
+    scorer = seq2seq.BleuScorer([pair[1] for pair in dev_pairs])
+    for precision in seq2seq.PRECISIONS:
+        start = time.perf_counter()
+        translated = seq2seq.translate_sentences(encoder, decoder, dev_pairs, src_vocab, tgt_vocab, precision=precision)
+        logging.info('precision %s dev BLEU:%.2f (translated in %.1fs)',
+                     precision, scorer.score(translated), time.perf_counter() - start)
+
+
+def bench_detokenize(args):
+    torch.manual_seed(args.seed)
+    _, tgt_vocab = seq2seq.make_vocabs('src', 'tgt', seq2seq.load_corpus(args.dev_file))
+    tgt_vocab.freeze()
+    indices, _ = tgt_vocab.encode_batch([pair[1] for pair in seq2seq.split_lines(args.dev_file)])
+    # as many rows as --n_sentences, drawn from the dev references (the EOS is kept)
+    indices = indices.t()[torch.randint(indices.size(1), (args.n_sentences,))]
+
+    ours = tgt_vocab.detokenize_batch(indices)
+    theirs = [seq2seq.clean(' '.join(words)) for words in tgt_vocab.decode_batch(indices)]
+    if ours != theirs:
+        raise AssertionError('detokenize_batch differs from clean() on %d sentences'
+                             % sum(a != b for a, b in zip(ours, theirs)))
+
+    ours_t = time_it(lambda: tgt_vocab.detokenize_batch(indices), args.repeat, warmup=1)
+    theirs_t = time_it(lambda: [seq2seq.clean(' '.join(words)) for words in tgt_vocab.decode_batch(indices)],
+                       args.repeat, warmup=1)
+    logging.info('detokenize %d sentences: decode_batch+clean:%.1fms detokenize_batch:%.1fms speedup:%.1fx',
+                 args.n_sentences, theirs_t * 1e3, ours_t * 1e3, theirs_t / ours_t)
+
+
+def perturbed_hypotheses(references, rng, keep=0.7):
+    """fake system output: each reference with some tokens replaced, dropped or added
+    """
+    vocab = [token for ref in references for token in ref.split()]
+    hypotheses = []
+    for ref in references:
+        tokens = [token if rng.random() < keep else rng.choice(vocab) for token in ref.split()]
+        if tokens and rng.random() < 0.3:
+            tokens.pop()
+        if rng.random() < 0.2:
+            tokens.append(rng.choice(vocab))
+        hypotheses.append(' '.join(tokens) + ' ' + seq2seq.EOS_token)
+    return hypotheses
+
+
+def bench_bleu(args):
+    from nltk.translate.bleu_score import corpus_bleu
+
+    references = [pair[1] for pair in seq2seq.split_lines(args.dev_file)]
+    rng = random.Random(args.seed)
+
+    start = time.perf_counter()
+    scorer = seq2seq.BleuScorer(references)
+    setup_t = time.perf_counter() - start
+
+    for keep in (0.9, 0.7, 0.5):
+        hypotheses = perturbed_hypotheses(references, rng, keep)
+        ours = scorer.score(hypotheses)
+        theirs = corpus_bleu([[seq2seq.clean(ref).split()] for ref in references],
+                             [seq2seq.clean(hyp).split() for hyp in hypotheses])
+        if abs(ours - theirs) > args.atol:
+            raise AssertionError('BleuScorer gave %.6f, nltk corpus_bleu %.6f' % (ours, theirs))
+
+        ours_t = time_it(lambda: scorer.score(hypotheses), args.repeat, warmup=1)
+        # what main() used to do at every evaluation: clean the references again, then nltk
+        theirs_t = time_it(lambda: corpus_bleu([[seq2seq.clean(ref).split()] for ref in references],
+                                               [seq2seq.clean(hyp).split() for hyp in hypotheses]),
+                           args.repeat, warmup=1)
+        logging.info('bleu keep=%.1f ours:%.4f nltk:%.4f  ours:%.1fms nltk:%.1fms speedup:%.1fx',
+                     keep, ours, theirs, ours_t * 1e3, theirs_t * 1e3, theirs_t / ours_t)
+    logging.info('bleu reference setup (once per run): %.1fms', setup_t * 1e3)
+
+
+######################################################################
+
+def bench_startup(args):
+    """wall-clock time of fresh interpreters: importing the modules and starting each CLI
+    """
+    commands = [
+        ('python', ['-c', 'pass']),
+        ('import torch', ['-c', 'import torch']),
+        ('import matplotlib.pyplot', ['-c', 'import matplotlib.pyplot']),
+        ('import seq2seq', ['-c', 'import seq2seq']),
+        ('seq2seq.py translate --help', ['seq2seq.py', 'translate', '--help']),
+        ('serve.py --help', ['serve.py', '--help']),
+    ]
+    for name, command in commands:
+        command = [sys.executable] + command
+        if subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode != 0:
+            logging.info('startup %-28s failed (not installed?)', name)
+            continue
+        run_t = time_it(lambda: subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL),
+                        args.runs, warmup=1)
+        logging.info('startup %-28s %.0fms', name, run_t * 1e3)
+
+    # the top-level packages seq2seq pulls in, by cumulative import time
+    importtime = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import seq2seq'],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True).stderr
+    packages = []
+    for line in importtime.splitlines():
+        fields = line.split('|')
+        if len(fields) == 3 and fields[1].strip().isdigit() and not fields[2].startswith('  '):
+            packages.append((int(fields[1]), fields[2].strip()))
+    for cumulative_us, package in sorted(packages, reverse=True)[:args.top]:
+        logging.info('import seq2seq: %-28s %.0fms', package, cumulative_us / 1e3)
+
+
+######################################################################
+# The end-to-end suite: every measurement is one named number in the results,
+# with its unit and whether lower or higher is better, so that two result files
+# can be compared metric by metric.
+#
+
+def timed(fn, repeat, trials, warmup=3):
+    """the median over trials of the mean seconds per call of fn() (see time_it)
+    """
+    times = sorted(time_it(fn, repeat, warmup if trial == 0 else 0) for trial in range(trials))
+    return times[len(times) // 2]
+
+
+class SuiteResults:
+    """ The metrics of one suite run, by name: {'value', 'unit', 'better': 'lower' or 'higher'}
+    """
+    def __init__(self):
+        self.metrics = {}
+
+    def add(self, name, value, unit, better='lower'):
+        self.metrics[name] = {'value': value, 'unit': unit, 'better': better}
+        logging.info('suite %-44s %12.3f %s', name, value, unit)
+
+    def add_peak_memory(self, section):
+        peak = seq2seq.peak_rss_mb()
+        if peak is not None:
+            # the process-wide peak so far, so it only grows from one section to the next
+            self.add('%s/peak_rss' % section, peak, 'MB')
+
+
+def suite_seed(seed):
+    random.seed(seed)
+    torch.manual_seed(seed)
+
+
+def suite_batching(args, results, train_corpus, src_vocab, tgt_vocab):
+    """building TrainingData from the tokenized corpus, and one epoch of get_batch()
+    """
+    suite_seed(args.seed)
+    start = time.perf_counter()
+    train_data = seq2seq.TrainingData(train_corpus, src_vocab, tgt_vocab, args.batch_size)
+    results.add('batching/setup', (time.perf_counter() - start) * 1e3, 'ms')
+
+    def epoch():
+        for ids in train_data.epoch_batches():
+            train_data.get_batch(ids)
+
+    epoch_t = timed(epoch, max(1, args.repeat // 10), args.trials, warmup=1)
+    results.add('batching/sentences_per_sec', len(train_data) / epoch_t, 'sentences/s', better='higher')
+    results.add_peak_memory('batching')
+
+
+def suite_train_step(args, results, train_corpus, src_vocab, tgt_vocab):
+    """one train() update (forward, backward, Adam) on real batches of the train set
+    """
+    for hidden_size in args.hidden_sizes:
+        for batch_size in args.batch_sizes:
+            suite_seed(args.seed)
+            train_data = seq2seq.TrainingData(train_corpus, src_vocab, tgt_vocab, batch_size)
+            batches = [train_data.get_batch(ids) for ids in train_data.epoch_batches()[:args.n_batches]]
+            encoder, decoder = seq2seq.make_model({'hidden_size': hidden_size, 'attn_model': args.attn_model},
+                                                  src_vocab, tgt_vocab)
+            optimizer = torch.optim.Adam(list(encoder.parameters()) + list(decoder.parameters()))
+            next_batch = itertools.cycle(batches)
+
+            def step():
+                seq2seq.train(*next(next_batch), encoder, decoder, optimizer)
+
+            name = 'train_step/hidden%d_batch%d' % (hidden_size, batch_size)
+            step_t = timed(step, args.repeat, args.trials)
+            n_tokens = sum(sum(batch[3]) for batch in batches) / len(batches)
+            results.add(name, step_t * 1e3, 'ms')
+            results.add(name + '_tgt_tokens_per_sec', n_tokens / step_t, 'tokens/s', better='higher')
+            # teacher forcing is drawn at random, so reseed to measure the same kind of step every run
+            random.seed(args.seed)
+            results.add(name + '_saved_for_backward', saved_activation_bytes(step) / 2 ** 20, 'MB')
+    results.add_peak_memory('train_step')
+
+
+def suite_attention(args, results):
+    """AttentionLayer.forward for one decoder step, from the encoder outputs and from a prebuilt memory
+    """
+    suite_seed(args.seed)
+    hidden_size = args.hidden_sizes[-1]
+    batch_size = args.batch_sizes[-1]
+    lengths = sorted([random_length(seq2seq.MAX_LENGTH) for _ in range(batch_size)], reverse=True)
+    lengths[0] = seq2seq.MAX_LENGTH
+    src_mask = seq2seq.sequence_mask(lengths, seq2seq.MAX_LENGTH)
+    hidden = torch.randn(1, batch_size, hidden_size, device=seq2seq.device)
+    encoder_outputs = torch.randn(seq2seq.MAX_LENGTH, batch_size, hidden_size, device=seq2seq.device)
+
+    for method in ('dot', 'general', 'concat'):
+        layer = seq2seq.AttentionLayer(method, hidden_size).to(seq2seq.device)
+        with torch.no_grad():
+            memory = layer.precompute(encoder_outputs, src_mask)
+            forward_t = timed(lambda: layer(hidden, encoder_outputs, src_mask), args.repeat * 10, args.trials)
+            memory_t = timed(lambda: layer(hidden, memory=memory), args.repeat * 10, args.trials)
+        name = 'attention/%s_hidden%d_batch%d' % (method, hidden_size, batch_size)
+        results.add(name, forward_t * 1e6, 'us')
+        results.add(name + '_with_memory', memory_t * 1e6, 'us')
+
+
+def suite_decode(args, results, encoder, decoder, src_vocab, tgt_vocab):
+    """translate_sentences over the whole dev set, greedy and with a beam
+    """
+    dev_pairs = seq2seq.split_lines(args.dev_file)
+    for beam_size in sorted({1, args.beam_size}):
+        suite_seed(args.seed)
+        decode_t = timed(lambda: seq2seq.translate_sentences(encoder, decoder, dev_pairs, src_vocab, tgt_vocab,
+                                                             beam_size=beam_size, detokenize=True),
+                         1, args.trials, warmup=1)
+        name = 'decode/dev_%s' % ('greedy' if beam_size == 1 else 'beam%d' % beam_size)
+        results.add(name, decode_t, 's')
+        results.add(name + '_sentences_per_sec', len(dev_pairs) / decode_t, 'sentences/s', better='higher')
+    results.add_peak_memory('decode')
+
+
+def suite_checkpoint(args, results, state, src_vocab, tgt_vocab):
+    """writing a training checkpoint and loading it back for inference
+    """
+    tmp_dir = tempfile.mkdtemp(prefix='bench_suite_')
+    try:
+        filename = os.path.join(tmp_dir, 'state_0000000000.pt')
+        # the vocabs go to their side file, as in training, however the checkpoint was loaded
+        vocab_file, fingerprint = seq2seq.save_vocabs(src_vocab, tgt_vocab, tmp_dir)
+        state = {key: value for key, value in state.items() if key not in ('src_vocab', 'tgt_vocab')}
+        state.update(vocab_file=vocab_file, vocab_fingerprint=fingerprint)
+        save_t = timed(lambda: seq2seq.atomic_save(state, filename), max(1, args.repeat // 10), args.trials, warmup=1)
+        load_t = timed(lambda: seq2seq.load_model(filename), max(1, args.repeat // 10), args.trials, warmup=1)
+        results.add('checkpoint/save', save_t * 1e3, 'ms')
+        results.add('checkpoint/load', load_t * 1e3, 'ms')
+        results.add('checkpoint/size', os.path.getsize(filename) / 2 ** 20, 'MB')
+    finally:
+        shutil.rmtree(tmp_dir)
+    results.add_peak_memory('checkpoint')
+
+
+def compare_results(metrics, baseline, tolerance):
+    """logs every metric next to its baseline value. returns the names of the metrics that got
+    worse by more than tolerance (relative to the baseline)
+    """
+    regressions = []
+    for name, metric in sorted(metrics.items()):
+        if name not in baseline:
+            continue
+        old, new = baseline[name]['value'], metric['value']
+        change = (new - old) / old if old else 0.0
+        worse = change > tolerance if metric['better'] == 'lower' else change < -tolerance
+        if worse:
+            regressions.append(name)
+        logging.info('compare %-44s %12.3f -> %12.3f %-11s %+6.1f%%%s',
+                     name, old, new, metric['unit'], change * 100, '  REGRESSION' if worse else '')
+    for name in sorted(set(baseline) - set(metrics)):
+        logging.info('compare %-44s not measured in this run', name)
+    return regressions
+
+
+def bench_suite(args):
+    torch.set_num_threads(args.threads)
+    results = SuiteResults()
+    start = time.perf_counter()
+
+    suite_seed(args.seed)
+    train_corpus = seq2seq.load_corpus(args.train_file)
+    src_vocab, tgt_vocab = seq2seq.make_vocabs('fr', 'en', train_corpus)
+    src_vocab.freeze()
+    tgt_vocab.freeze()
+
+    suite_batching(args, results, train_corpus, src_vocab, tgt_vocab)
+    suite_train_step(args, results, train_corpus, src_vocab, tgt_vocab)
+    suite_attention(args, results)
+
+    if args.checkpoint is not None:
+        state = seq2seq.load_checkpoint(args.checkpoint)
+        encoder, decoder, src_vocab, tgt_vocab = seq2seq.build_model(state)
+        suite_decode(args, results, encoder, decoder, src_vocab, tgt_vocab)
+    else:
+        # an untrained model never stops before max_length, which keeps the decoding work fixed
+        suite_seed(args.seed)
+        model_config = {'hidden_size': args.hidden_sizes[-1], 'attn_model': args.attn_model}
+        encoder, decoder = seq2seq.make_model(model_config, src_vocab, tgt_vocab)
+        suite_decode(args, results, encoder, decoder, src_vocab, tgt_vocab)
+
+        # one update, so the checkpoint carries the Adam state as well, like a real one
+        optimizer = torch.optim.Adam(list(encoder.parameters()) + list(decoder.parameters()))
+        train_data = seq2seq.TrainingData(train_corpus, src_vocab, tgt_vocab, args.batch_size)
+        seq2seq.train(*train_data.get_batch(train_data.epoch_batches()[0]), encoder, decoder, optimizer)
+        state = {'iter_num': 1,
+                 'enc_state': encoder.state_dict(),
+                 'dec_state': decoder.state_dict(),
+                 'opt_state': optimizer.state_dict(),
+                 'model_config': model_config,
+                 }
+    suite_checkpoint(args, results, state, src_vocab, tgt_vocab)
+
+    report = {'config': {'seed': args.seed,
+                         'threads': args.threads,
+                         'repeat': args.repeat,
+                         'trials': args.trials,
+                         'hidden_sizes': args.hidden_sizes,
+                         'batch_sizes': args.batch_sizes,
+                         'attn_model': args.attn_model,
+                         'checkpoint': args.checkpoint,
+                         'torch': torch.__version__,
+                         'python': platform.python_version(),
+                         'machine': platform.machine(),
+                         'processor': platform.processor(),
+                         },
+              'elapsed_sec': time.perf_counter() - start,
+              'metrics': results.metrics,
+              }
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    logging.info('wrote %d metrics to %s in %.0fs', len(results.metrics), args.out, report['elapsed_sec'])
+
+    if args.baseline is None:
+        return
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline['config']['threads'] != args.threads or baseline['config']['seed'] != args.seed:
+        logging.warning('%s was run with other seeds or threads, the comparison may not mean much', args.baseline)
+    regressions = compare_results(results.metrics, baseline['metrics'], args.tolerance)
+    if regressions:
+        logging.error('%d regression(s) beyond %.0f%% against %s: %s',
+                      len(regressions), args.tolerance * 100, args.baseline, ', '.join(regressions))
+        sys.exit(1)
+    logging.info('no regressions beyond %.0f%% against %s', args.tolerance * 100, args.baseline)
+
+
+######################################################################
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--seed', default=0, type=int,
+                    help='random seed')
+    ap.add_argument('--repeat', default=50, type=int,
+                    help='number of timed calls per measurement')
+    sub = ap.add_subparsers(dest='bench')
+    sub.required = True
+
+    ap_attn = sub.add_parser('attention', help='batched AttentionLayer vs the per-cell score() loop')
+    ap_attn.add_argument('--hidden_size', default=256, type=int)
+    ap_attn.add_argument('--batch_size', default=8, type=int)
+    ap_attn.add_argument('--src_len', default=seq2seq.MAX_LENGTH, type=int)
+    ap_attn.add_argument('--atol', default=1e-5, type=float,
+                         help='tolerance when comparing the two paths')
+    ap_attn.set_defaults(func=bench_attention)
+
+    ap_rnn = sub.add_parser('rnn', help='seq2seq.LSTM vs nn.LSTM and nn.GRU, forward + backward')
+    ap_rnn.add_argument('--hidden_sizes', default=[128, 256, 512], type=int, nargs='+')
+    ap_rnn.add_argument('--batch_sizes', default=[8, 32, 64], type=int, nargs='+')
+    ap_rnn.add_argument('--seq_len', default=seq2seq.MAX_LENGTH, type=int)
+    ap_rnn.add_argument('--bidirectional', action='store_true')
+    ap_rnn.add_argument('--atol', default=1e-5, type=float,
+                        help='tolerance when comparing LSTM against nn.LSTM')
+    ap_rnn.set_defaults(func=bench_rnn)
+
+    ap_softmax = sub.add_parser('softmax', help='adaptive vs dense output head: training step, memory, exact top-k')
+    ap_softmax.add_argument('--vocab_sizes', default=[8000, 32000, 100000], type=int, nargs='+')
+    ap_softmax.add_argument('--hidden_size', default=256, type=int)
+    ap_softmax.add_argument('--batch_size', default=64, type=int)
+    ap_softmax.add_argument('--tgt_len', default=seq2seq.MAX_LENGTH, type=int)
+    ap_softmax.add_argument('--k', default=5, type=int,
+                            help='top-k taken from the full scores at decode time')
+    ap_softmax.set_defaults(func=bench_softmax)
+
+    ap_precision = sub.add_parser('precision', help='bf16 autocast vs fp32: train step, greedy decoding, dev BLEU')
+    ap_precision.add_argument('--hidden_sizes', default=[128, 256, 512], type=int, nargs='+')
+    ap_precision.add_argument('--batch_size', default=32, type=int)
+    ap_precision.add_argument('--vocab_size', default=8000, type=int)
+    ap_precision.add_argument('--attn_model', default='general', choices=['dot', 'general', 'concat'])
+    ap_precision.add_argument('--output_head', default='dense', choices=['dense', 'adaptive'])
+    ap_precision.add_argument('--checkpoint', default=None,
+                              help='also compare dev BLEU of this checkpoint in both precisions')
+    ap_precision.add_argument('--dev_file', default='data/fren.dev.bpe')
+    ap_precision.set_defaults(func=bench_precision)
+
+    ap_detok = sub.add_parser('detokenize', help='Vocab.detokenize_batch vs decode_batch + clean()')
+    ap_detok.add_argument('--dev_file', default='data/fren.dev.bpe')
+    ap_detok.add_argument('--n_sentences', default=100000, type=int)
+    ap_detok.set_defaults(func=bench_detokenize)
+
+    ap_bleu = sub.add_parser('bleu', help='BleuScorer vs nltk corpus_bleu on the dev set')
+    ap_bleu.add_argument('--dev_file', default='data/fren.dev.bpe')
+    ap_bleu.add_argument('--atol', default=1e-9, type=float,
+                         help='tolerance when comparing against nltk')
+    ap_bleu.set_defaults(func=bench_bleu)
+
+    ap_startup = sub.add_parser('startup', help='interpreter startup: module import times and CLI start-up')
+    ap_startup.add_argument('--runs', default=5, type=int,
+                            help='timed runs per command')
+    ap_startup.add_argument('--top', default=10, type=int,
+                            help='number of slowest imports of seq2seq to list')
+    ap_startup.set_defaults(func=bench_startup)
+
+    ap_suite = sub.add_parser('suite', help='end-to-end suite on the fren data: batching, train step, attention, '
+                                            'dev decoding, checkpoint save/load and peak memory, saved as JSON')
+    ap_suite.add_argument('--train_file', default='data/fren.train.bpe')
+    ap_suite.add_argument('--dev_file', default='data/fren.dev.bpe')
+    ap_suite.add_argument('--threads', default=1, type=int,
+                          help='intra-op threads (fixed, so runs on the same machine are comparable)')
+    ap_suite.add_argument('--trials', default=5, type=int,
+                          help='each timing is the median over this many trials of --repeat calls')
+    ap_suite.add_argument('--hidden_sizes', default=[128, 256], type=int, nargs='+',
+                          help='train step sizes; the largest is also used for attention, decoding and checkpoints')
+    ap_suite.add_argument('--batch_sizes', default=[16, 64], type=int, nargs='+')
+    ap_suite.add_argument('--batch_size', default=32, type=int,
+                          help='batch size of the batching throughput measurement')
+    ap_suite.add_argument('--n_batches', default=8, type=int,
+                          help='distinct train batches cycled through by the train step measurement')
+    ap_suite.add_argument('--attn_model', default='general', choices=['dot', 'general', 'concat'])
+    ap_suite.add_argument('--beam_size', default=5, type=int,
+                          help='beam width of the beam search dev decode (greedy is always measured too)')
+    ap_suite.add_argument('--checkpoint', default=None,
+                          help='decode and save/load this checkpoint instead of an untrained model')
+    ap_suite.add_argument('--out', default='bench_suite.json',
+                          help='file the results are written to')
+    ap_suite.add_argument('--baseline', default=None,
+                          help='results of an earlier run to compare against; exits with status 1 on regressions')
+    ap_suite.add_argument('--tolerance', default=0.10, type=float,
+                          help='relative change past which a metric counts as a regression')
+    ap_suite.set_defaults(func=bench_suite)
+
+    args = ap.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
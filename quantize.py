@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Post-training dynamic int8 quantization of a checkpoint, for CPU inference.
+
+    python quantize.py state_0000100000.pt --out model_int8.pt --report quantize_report.json
+
+The exported model can be given to serve.py in place of the checkpoint. The report
+compares it against the fp32 checkpoint: serialized size, decoding latency and dev BLEU.
+"""
+
+
+from __future__ import unicode_literals, print_function, division
+
+import argparse
+import io
+import json
+import logging
+import time
+
+import torch
+
+import seq2seq
+
+
+def quantize_decoder(decoder):
+    """int8 dynamic quantization (int8 weights, activations quantized on the fly) of the decoder's
+    Linear layers: concat, the output layer and the 'general' attention projection.
+    the 'concat' attention projection is left alone, since precompute() slices its weight.
+    the LSTMs keep their fp32 weights: their time loop uses the raw parameters, not nn.Linear
+    """
+    layers = {'concat', 'out' if decoder.out is not None else 'adaptive_out'}
+    if decoder.attn_model == 'general':
+        layers.add('attn.attn')
+    return torch.ao.quantization.quantize_dynamic(decoder, layers, dtype=torch.qint8)
+
+
+def serialized_bytes(*modules):
+    buffer = io.BytesIO()
+    torch.save([module.state_dict() for module in modules], buffer)
+    return buffer.tell()
+
+
+def measure(encoder, decoder, src_vocab, tgt_vocab, dev_pairs, scorer, args):
+    """dev BLEU, sentences/sec at --batch_size, and per-sentence latency at batch size 1
+    """
+    with torch.inference_mode():
+        start = time.perf_counter()
+        translated = seq2seq.translate_sentences(encoder, decoder, dev_pairs, src_vocab, tgt_vocab,
+                                                 batch_size=args.batch_size, beam_size=args.beam_size,
+                                                 detokenize=True)
+        batch_t = time.perf_counter() - start
+
+        latencies = []
+        for pair in dev_pairs[:args.latency_sentences]:
+            start = time.perf_counter()
+            seq2seq.translate_sentences(encoder, decoder, [pair], src_vocab, tgt_vocab, beam_size=args.beam_size)
+            latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return {'dev_bleu': scorer.score(translated, detokenized=True),
+            'sentences_per_sec': len(dev_pairs) / batch_t,
+            'latency_p50_ms': latencies[len(latencies) // 2] * 1e3,
+            'latency_p99_ms': latencies[int(0.99 * (len(latencies) - 1))] * 1e3,
+            }
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('checkpoint',
+                    help='state_*.pt checkpoint to quantize')
+    ap.add_argument('--out', default='model_int8.pt',
+                    help='file the quantized model is exported to')
+    ap.add_argument('--report', default='quantize_report.json',
+                    help='file the fp32 vs int8 comparison is written to')
+    ap.add_argument('--dev_file', default='data/fren.dev.bpe',
+                    help='dev file the two models are compared on')
+    ap.add_argument('--batch_size', default=64, type=int,
+                    help='number of sentences decoded together for the throughput measurement')
+    ap.add_argument('--beam_size', default=1, type=int,
+                    help='beam width (1 means greedy decoding)')
+    ap.add_argument('--latency_sentences', default=200, type=int,
+                    help='number of dev sentences translated one at a time for the latency measurement')
+    ap.add_argument('--threads', default=None, type=int,
+                    help='intra-op threads')
+    args = ap.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    encoder, decoder, src_vocab, tgt_vocab = seq2seq.load_model(args.checkpoint)
+    seq2seq.export_model(args.out, encoder, quantize_decoder(decoder), src_vocab, tgt_vocab,
+                         info={'checkpoint': args.checkpoint, 'quantization': 'dynamic int8'})
+    # compare against what was actually written, so the report also checks the export loads and runs
+    int8_encoder, int8_decoder, _, _ = seq2seq.load_model(args.out)
+
+    dev_pairs = seq2seq.split_lines(args.dev_file)
+    scorer = seq2seq.BleuScorer([pair[1] for pair in dev_pairs])
+    report = {'checkpoint': args.checkpoint,
+              'export': args.out,
+              'fp32': measure(encoder, decoder, src_vocab, tgt_vocab, dev_pairs, scorer, args),
+              'int8': measure(int8_encoder, int8_decoder, src_vocab, tgt_vocab, dev_pairs, scorer, args),
+              }
+    report['fp32']['weights_mb'] = serialized_bytes(encoder, decoder) / 2 ** 20
+    report['int8']['weights_mb'] = serialized_bytes(int8_encoder, int8_decoder) / 2 ** 20
+
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent=2)
+    for name in ('fp32', 'int8'):
+        logging.info('%s: %s', name, ' '.join('%s:%.2f' % item for item in sorted(report[name].items())))
+    logging.info('wrote %s and %s', args.out, args.report)
+
+
+if __name__ == '__main__':
+    main()
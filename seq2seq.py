@@ -12,25 +12,32 @@ Students *MAY NOT* view the above tutorial or use it as a reference in any way.
 from __future__ import unicode_literals, print_function, division
 
 import argparse
+import collections
+import contextlib
+import hashlib
+import inspect
+import io
+import itertools
+import json
 import logging
+import math
+import mmap
+import os
+import queue
 import random
+import sys
+import threading
 import time
+from array import array
 from io import open
 
-import matplotlib
-#if you are running on the gradx/ugradx/ another cluster, 
-#you will need the following line
-#if you run on a local machine, you can comment it out
-#matplotlib.use('agg') 
-import matplotlib.pyplot as plt
-import matplotlib.ticker as ticker
 import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
 import torch.nn as nn
 import torch.nn.functional as F
-from nltk.translate.bleu_score import corpus_bleu
 from torch import optim
-from torch.autograd import Variable
-from torch.nn.utils.rnn import pad_packed_sequence, pack_padded_sequence
+from torch.nn.utils.rnn import PackedSequence, pad_packed_sequence, pack_padded_sequence
 
 
 logging.basicConfig(level=logging.DEBUG,
@@ -45,41 +52,204 @@ device = torch.device("cpu")
 PAD_token = "<PAD>"
 SOS_token = "<SOS>"
 EOS_token = "<EOS>"
+UNK_token = "<UNK>"
 
 PAD_index = 0
 SOS_index = 1
 EOS_index = 2
+UNK_index = 3
+SPECIAL_TOKENS = [PAD_token, SOS_token, EOS_token, UNK_token]
 MAX_LENGTH = 15
 teacher_force_ratio = 0.5
 
 
 class Vocab:
     """ This class handles the mapping between the words and their indicies
+    Words missing from the vocab map to UNK_index.
     """
     def __init__(self, lang_code):
         self.lang_code = lang_code
-        self.cut = False
+        self.frozen = False
         self.word2index = {}
         self.word2count = {}
-        self.index2word = {PAD_index: PAD_token, SOS_index: SOS_token, EOS_index: EOS_token}
-        self.n_words = 3 
+        self.index2word = dict(enumerate(SPECIAL_TOKENS))
+        self.n_words = len(SPECIAL_TOKENS)
+        self._detokenizer = None
 
     def add_sentence(self, sentence):
         for word in sentence.split(' '):
             self._add_word(word)
 
-    def _add_word(self, word):
+    def _add_word(self, word, count=1):
+        if self.frozen:
+            raise RuntimeError('cannot add "%s" to the frozen %s vocab' % (word, self.lang_code))
         if word not in self.word2index:
             self.word2index[word] = self.n_words
-            self.word2count[word] = 1
+            self.word2count[word] = count
             self.index2word[self.n_words] = word
             self.n_words += 1
         else:
-            self.word2count[word] += 1
+            self.word2count[word] += count
+
+    def freeze(self, min_count=1, max_size=None):
+        """prunes words seen fewer than min_count times, and all but the max_size most frequent
+        words if max_size is given. the remaining words are renumbered by descending count
+        and the vocab can no longer grow; pruned words map to UNK_index from now on
+        """
+        # sorted() is stable, so words with equal counts stay in order of first appearance
+        kept = [word for word in sorted(self.word2index, key=self.word2count.get, reverse=True)
+                if self.word2count[word] >= min_count]
+        if max_size is not None:
+            kept = kept[:max_size]
+        unk_count = sum(self.word2count.values()) - sum(self.word2count[word] for word in kept)
+
+        self.word2index = {word: i for i, word in enumerate(kept, len(SPECIAL_TOKENS))}
+        self.word2count = {word: self.word2count[word] for word in kept}
+        self.word2count[UNK_token] = unk_count
+        self.index2word = dict(enumerate(SPECIAL_TOKENS + kept))
+        self.n_words = len(self.index2word)
+        self.frozen = True
+        logging.info('froze %s vocab at %d words (%d tokens now map to %s)',
+                     self.lang_code, self.n_words, unk_count, UNK_token)
+
+    def encode_batch(self, sentences):
+        """converts a list of sentences into a padded (max_length x batch) LongTensor of indices,
+        with EOS_index appended to every sentence. returns the tensor and the list of lengths
+        """
+        split_sentences = [sentence.split(' ') for sentence in sentences]
+        lengths = [len(words) + 1 for words in split_sentences]
+        indices = list(map(self.word2index.get, itertools.chain.from_iterable(split_sentences),
+                           itertools.repeat(UNK_index)))
+
+        eos_positions = torch.tensor(lengths).unsqueeze(1) - 1
+        positions = torch.arange(max(lengths)).unsqueeze(0)
+        padded = torch.full((len(sentences), max(lengths)), PAD_index, dtype=torch.long)
+        padded[positions < eos_positions] = torch.tensor(indices, dtype=torch.long)
+        padded[positions == eos_positions] = EOS_index
+        return padded.t().contiguous(), lengths
+
+    def decode_batch(self, indices):
+        """converts a (batch x steps) tensor of indices back into lists of words.
+        every row stops at its first EOS_index (kept, as EOS_token) or PAD_index
+        """
+        return [list(map(self.index2word.__getitem__, row)) for row in self._rows(indices)]
+
+    def detokenize_batch(self, indices):
+        """like decode_batch, but returns each row as the finished sentence:
+        what clean(' '.join(words)) gives, without building the BPE string first
+        """
+        if self._detokenizer is None or self._detokenizer.n_words != self.n_words:
+            self._detokenizer = Detokenizer(self)
+        return self._detokenizer(self._rows(indices))
+
+    @staticmethod
+    def _rows(indices):
+        """the rows of a (batch x steps) tensor as lists, each up to its first EOS_index (included) or PAD_index
+        """
+        steps = indices.size(1)
+        stops = (indices == EOS_index) | (indices == PAD_index)
+        lengths = torch.where(stops.any(1), stops.long().argmax(1), torch.full_like(indices[:, 0], steps))
+        ends_with_eos = indices.gather(1, lengths.clamp(max=steps - 1).unsqueeze(1)).squeeze(1) == EOS_index
+        lengths += (ends_with_eos & (lengths < steps)).long()
+        return [row[:length] for row, length in zip(indices.tolist(), lengths.tolist())]
+
+    def to_state(self):
+        """the compact serialized form of the vocab: all words in index order joined by
+        newlines, plus their counts as one int tensor
+        """
+        return {'lang_code': self.lang_code,
+                'frozen': self.frozen,
+                'words': '\n'.join(self.index2word[i] for i in range(self.n_words)),
+                'counts': self.index_counts(),
+                }
+
+    def index_counts(self):
+        """the count of every word as one int tensor, in index order (0 for the special tokens,
+        except UNK once frozen). after freeze() it is sorted by descending count past the specials
+        """
+        return torch.tensor([self.word2count.get(self.index2word[i], 0) for i in range(self.n_words)],
+                            dtype=torch.long)
+
+    @classmethod
+    def from_state(cls, state):
+        vocab = cls(state['lang_code'])
+        words = state['words'].split('\n')
+        vocab.index2word = dict(enumerate(words))
+        vocab.word2index = {word: i for i, word in enumerate(words[len(SPECIAL_TOKENS):], len(SPECIAL_TOKENS))}
+        vocab.word2count = {word: count for word, count in zip(words, state['counts'].tolist()) if count}
+        vocab.n_words = len(words)
+        vocab.frozen = state['frozen']
+        return vocab
+
+
+class Detokenizer:
+    """ Turns rows of target indices into finished sentences, the same as clean() does
+    for the joined BPE string. Every index gets a precomputed piece: its word with any
+    BPE continuation marker cut off, followed by a space unless it continues into the
+    next token (PAD and EOS vanish; SOS and UNK stay, as they do in clean()), so a
+    sentence is one join.
+    """
+    SKIPPED = (PAD_token, EOS_token)
+
+    def __init__(self, vocab):
+        self.n_words = vocab.n_words
+        self.words = [vocab.index2word[i] for i in range(vocab.n_words)]
+        self.pieces = []
+        self.continues = []
+        for word in self.words:
+            if word in self.SKIPPED:
+                self.pieces.append('')
+                self.continues.append(False)
+            elif word.endswith('@@'):
+                self.pieces.append(word[:-2])
+                self.continues.append(True)
+            else:
+                self.pieces.append(word + ' ')
+                self.continues.append(False)
+
+    def __call__(self, rows):
+        """rows: lists of indices, each ending at (or with) its EOS_index
+        """
+        pieces, continues = self.pieces, self.continues
+        sentences = []
+        for row in rows:
+            if row and continues[row[-1]]:
+                # clean() only joins a marker that is followed by something, a dangling one stays
+                sentences.append(''.join(map(pieces.__getitem__, row[:-1])) + self.words[row[-1]])
+            else:
+                sentences.append(''.join(map(pieces.__getitem__, row)).rstrip(' '))
+        return sentences
 
 
 ######################################################################
 
+def _line_spans(mm):
+    """yields the (start, end) byte offsets of every non-empty line of an mmap'd file
+    """
+    start = 0
+    size = len(mm)
+    while start < size:
+        end = mm.find(b'\n', start)
+        if end == -1:
+            end = size
+        if end > start:
+            yield start, end
+        start = end + 1
+
+
+def iter_pairs(input_file):
+    """lazily yields the pairs of a file like:
+    first src sentence|||first tgt sentence
+    second src sentence|||second tgt sentence
+    reading it through mmap instead of loading the whole file into memory
+    """
+    if os.path.getsize(input_file) == 0:
+        return
+    with open(input_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for start, end in _line_spans(mm):
+            yield mm[start:end].decode('utf-8').split('|||')
+
+
 def split_lines(input_file):
     """split a file like:
     first src sentence|||first tgt sentence
@@ -89,68 +259,417 @@ def split_lines(input_file):
      ("second src sentence", "second tgt sentence")]
     """
     logging.info("Reading lines of %s...", input_file)
-    # Read the file and split into lines
-    lines = open(input_file, encoding='utf-8').read().strip().split('\n')
-    # Split every line into pairs
-    pairs = [l.split('|||') for l in lines]
-    return pairs
+    return list(iter_pairs(input_file))
+
+
+class LineIndex:
+    """ Random access to the pairs of a |||-file without reading it into memory.
+    The byte offsets of all lines are found once; lines are then decoded
+    on demand from the mmap'd file. Close it (or use it as a context manager)
+    to release the mmap and the file handle.
+    """
+    def __init__(self, input_file):
+        self.input_file = input_file
+        self.starts = array('q')
+        self.ends = array('q')
+        self._file = open(input_file, 'rb')
+        self._mm = None
+        try:
+            if os.path.getsize(input_file) > 0:
+                self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+                for start, end in _line_spans(self._mm):
+                    self.starts.append(start)
+                    self.ends.append(end)
+        except Exception:
+            self.close()
+            raise
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, i):
+        """the (src, tgt) pair on line i (of the non-empty lines)
+        """
+        src, tgt = self._mm[self.starts[i]:self.ends[i]].decode('utf-8').split('|||')
+        return src, tgt
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _to_tensor(values, dtype):
+    """copies an array.array into a tensor of the matching dtype
+    """
+    if len(values) == 0:
+        return torch.zeros(0, dtype=dtype)
+    return torch.frombuffer(values, dtype=dtype).clone()
+
+
+class TokenizedCorpus:
+    """ A parallel corpus stored as token ids rather than strings.
+    For each side there is a type table (the distinct tokens, in order of first
+    appearance), one flat int32 tensor of type ids, and an offsets tensor with
+    one entry per sentence plus an end sentinel, so sentence i is
+    tokens[offsets[i]:offsets[i + 1]].
+    This is also the format of the binary corpus cache (see load_corpus).
+    """
+    def __init__(self, src_types, src_tokens, src_offsets, tgt_types, tgt_tokens, tgt_offsets):
+        self.src_types = src_types
+        self.src_tokens = src_tokens
+        self.src_offsets = src_offsets
+        self.tgt_types = tgt_types
+        self.tgt_tokens = tgt_tokens
+        self.tgt_offsets = tgt_offsets
+
+    def __len__(self):
+        return self.src_offsets.numel() - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return [self._sentence(self.src_types, self.src_tokens, self.src_offsets, i),
+                self._sentence(self.tgt_types, self.tgt_tokens, self.tgt_offsets, i)]
+
+    @staticmethod
+    def _sentence(types, tokens, offsets, i):
+        return ' '.join(types[t] for t in tokens[offsets[i]:offsets[i + 1]].tolist())
+
+    @classmethod
+    def from_pairs(cls, pairs):
+        """tokenizes an iterable of (src, tgt) pairs, e.g. iter_pairs(input_file)
+        """
+        sides = [({}, array('i'), array('q', [0])) for _ in range(2)]
+        for pair in pairs:
+            for (type_ids, tokens, offsets), sentence in zip(sides, pair):
+                for word in sentence.split(' '):
+                    tokens.append(type_ids.setdefault(word, len(type_ids)))
+                offsets.append(len(tokens))
+
+        (src_type_ids, src_tokens, src_offsets), (tgt_type_ids, tgt_tokens, tgt_offsets) = sides
+        return cls(list(src_type_ids), _to_tensor(src_tokens, torch.int32), _to_tensor(src_offsets, torch.int64),
+                   list(tgt_type_ids), _to_tensor(tgt_tokens, torch.int32), _to_tensor(tgt_offsets, torch.int64))
+
+    def save(self, filename):
+        atomic_save({'src_types': '\n'.join(self.src_types),
+                     'src_tokens': self.src_tokens,
+                     'src_offsets': self.src_offsets,
+                     'tgt_types': '\n'.join(self.tgt_types),
+                     'tgt_tokens': self.tgt_tokens,
+                     'tgt_offsets': self.tgt_offsets,
+                     }, filename)
+
+    @classmethod
+    def load(cls, filename):
+        state = torch.load(filename)
+        return cls(state['src_types'].split('\n'), state['src_tokens'], state['src_offsets'],
+                   state['tgt_types'].split('\n'), state['tgt_tokens'], state['tgt_offsets'])
+
+
+def file_fingerprint(input_file):
+    """the sha1 of a file's contents together with its mtime, used to key the corpus cache
+    """
+    sha1 = hashlib.sha1()
+    with open(input_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+    return '%s-%d' % (sha1.hexdigest()[:16], os.stat(input_file).st_mtime_ns)
+
+
+def load_corpus(input_file, cache_dir=None):
+    """returns input_file as a TokenizedCorpus. if cache_dir is given, the tokenized corpus
+    is cached there and later runs on the same (unchanged) file skip parsing entirely
+    """
+    if cache_dir is None:
+        logging.info("Reading lines of %s...", input_file)
+        return TokenizedCorpus.from_pairs(iter_pairs(input_file))
+
+    cache_file = os.path.join(cache_dir, '%s.%s.pt' % (os.path.basename(input_file), file_fingerprint(input_file)))
+    if os.path.exists(cache_file):
+        logging.info("Loading tokenized %s from %s", input_file, cache_file)
+        return TokenizedCorpus.load(cache_file)
+
+    logging.info("Reading lines of %s...", input_file)
+    corpus = TokenizedCorpus.from_pairs(iter_pairs(input_file))
+    os.makedirs(cache_dir, exist_ok=True)
+    corpus.save(cache_file)
+    logging.debug('wrote corpus cache to %s', cache_file)
+    return corpus
 
 
-def make_vocabs(src_lang_code, tgt_lang_code, train_file):
-    """ Creates the vocabs for each of the langues based on the training corpus.
+def make_vocabs(src_lang_code, tgt_lang_code, train_corpus):
+    """ Creates the vocabs for each of the langues based on the training corpus (a TokenizedCorpus).
     """
     src_vocab = Vocab(src_lang_code)
     tgt_vocab = Vocab(tgt_lang_code)
 
-    train_pairs = split_lines(train_file)
-
-    for pair in train_pairs:
-        src_vocab.add_sentence(pair[0])
-        tgt_vocab.add_sentence(pair[1])
+    # the type tables are in order of first appearance, so words get the same
+    # indices as if the sentences had been added one by one
+    src_counts = torch.bincount(train_corpus.src_tokens.long(), minlength=len(train_corpus.src_types))
+    for word, count in zip(train_corpus.src_types, src_counts.tolist()):
+        src_vocab._add_word(word, count)
+    tgt_counts = torch.bincount(train_corpus.tgt_tokens.long(), minlength=len(train_corpus.tgt_types))
+    for word, count in zip(train_corpus.tgt_types, tgt_counts.tolist()):
+        tgt_vocab._add_word(word, count)
 
     logging.info('%s (src) vocab size: %s', src_vocab.lang_code, src_vocab.n_words)
     logging.info('%s (tgt) vocab size: %s', tgt_vocab.lang_code, tgt_vocab.n_words)
 
-    return src_vocab, tgt_vocab, train_pairs
+    return src_vocab, tgt_vocab
 
 ######################################################################
 
 def add_indices_from_sentence(lang, sentence):
-    return [lang.word2index[word] for word in sentence.split(' ')] + [EOS_index]
+    return [lang.word2index.get(word, UNK_index) for word in sentence.split(' ')] + [EOS_index]
 
-def add_padding(seq, max_length):
-    seq += [0 for i in range(max_length - len(seq))]
-    return seq
+def sequence_mask(lengths, max_length=None):
+    """returns a (batch x max_length) bool mask which is True at the real (non-pad) positions
+    """
+    lengths = torch.as_tensor(lengths, device=device)
+    if max_length is None:
+        max_length = int(lengths.max())
+    return torch.arange(max_length, device=device).unsqueeze(0) < lengths.unsqueeze(1)
 
-def mini_batch(batch_size, pairs, input_lang, output_lang):
-    input_seqs = []
-    target_seqs = []
 
-    # Choose random pairs
-    for i in range(batch_size):
-        pair = random.choice(pairs)
-        input_seqs.append(add_indices_from_sentence(input_lang, pair[0]))
-        target_seqs.append(add_indices_from_sentence(output_lang, pair[1]))
+PRECISIONS = ['fp32', 'bf16']
 
-    # Zip into pairs, sort by length (descending), unzip
-    seq_pairs = sorted(zip(input_seqs, target_seqs), key=lambda p: len(p[0]), reverse=True)
-    input_seqs, target_seqs = zip(*seq_pairs)
 
-    # For input and target sequences, get array of lengths and pad with 0s to max length
-    input_lengths = [len(s) for s in input_seqs]
-    input_padded = [add_padding(s, max(input_lengths)) for s in input_seqs]
-    target_lengths = [len(s) for s in target_seqs]
-    target_padded = [add_padding(s, max(target_lengths)) for s in target_seqs]
-
-    # Turn padded arrays into (batch x seq) tensors, transpose into (seq x batch)
-    input_var = Variable(torch.LongTensor(input_padded)).transpose(0, 1)
-    target_var = Variable(torch.LongTensor(target_padded)).transpose(0, 1)
+def autocast(precision='fp32'):
+    """the context the model runs in for --precision: bf16 runs the matmuls (embedding
+    projections, rnn, attention, output layer) under CPU autocast, fp32 changes nothing.
+    parameters, gradients and optimizer state stay fp32 either way
+    """
+    return torch.autocast('cpu', dtype=torch.bfloat16, enabled=precision == 'bf16')
+
+class TrainingData:
+    """ The training corpus, converted to indices once up front.
+    Each side is kept as one flat contiguous LongTensor plus an offsets array
+    (sentence i is tokens[offsets[i]:offsets[i] + lengths[i]]).
+    Sentences are grouped into buckets by source length, so batches need
+    (almost) no source padding, and batches are drawn by shuffling every
+    bucket once per epoch rather than sampling pairs with replacement.
+    With world_size > 1 only every world_size-th pair (starting at rank) is batched,
+    so each data-parallel worker gets its own shard.
+    With max_tokens, batches are not batch_size sentences but as many sentences as fit
+    into max_tokens source + target tokens, padding included.
+    """
+    def __init__(self, corpus, src_vocab, tgt_vocab, batch_size, bucket_width=1, rank=0, world_size=1,
+                 max_tokens=None):
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.epoch = 0
+
+        self.src_tokens, self.src_offsets, self.src_lengths = self._encode(
+            corpus.src_types, corpus.src_tokens, corpus.src_offsets, src_vocab)
+        self.tgt_tokens, self.tgt_offsets, self.tgt_lengths = self._encode(
+            corpus.tgt_types, corpus.tgt_tokens, corpus.tgt_offsets, tgt_vocab)
+
+        buckets = {}
+        shard = range(rank, len(self), world_size)
+        for i, length in zip(shard, self.src_lengths[rank::world_size].tolist()):
+            buckets.setdefault(length // bucket_width, []).append(i)
+        self.buckets = [torch.tensor(ids) for _, ids in sorted(buckets.items())]
+
+        logging.info('training data: %d pairs (%d in this shard), %d src / %d tgt tokens, %d length buckets',
+                     len(self), len(shard), self.src_tokens.numel(), self.tgt_tokens.numel(), len(self.buckets))
+
+    def __len__(self):
+        return self.src_lengths.numel()
+
+    @staticmethod
+    def _encode(types, type_ids, offsets, vocab):
+        """maps the type ids of one side of a TokenizedCorpus to vocab indices
+        and appends EOS_index to every sentence
+        """
+        type_to_index = torch.tensor([vocab.word2index.get(word, UNK_index) for word in types], dtype=torch.long)
+        lengths = offsets[1:] - offsets[:-1]
+        n_sentences = lengths.numel()
+        # token j of sentence i moves up by i places, one for each EOS inserted before it
+        shifted = torch.arange(type_ids.numel()) + torch.arange(n_sentences).repeat_interleave(lengths)
+        tokens = torch.full((type_ids.numel() + n_sentences,), EOS_index, dtype=torch.long)
+        tokens[shifted] = type_to_index[type_ids.long()]
+        return tokens, offsets[:-1] + torch.arange(n_sentences), lengths + 1
+
+    @staticmethod
+    def _gather(tokens, offsets, lengths, ids):
+        """slices the sentences ids out of a flat token tensor into a padded (seq x batch) tensor
+        """
+        lengths = lengths[ids]
+        positions = torch.arange(int(lengths.max())).unsqueeze(1)
+        mask = positions < lengths.unsqueeze(0)
+        index = (offsets[ids].unsqueeze(0) + positions).masked_fill(~mask, 0)
+        return tokens[index].masked_fill(~mask, PAD_index), lengths.tolist()
+
+    def get_batch(self, ids):
+        """builds the (input_var, input_lengths, target_var, target_lengths) batch for the sentences ids
+        """
+        # sort by source length (descending) for pack_padded_sequence
+        ids = ids[self.src_lengths[ids].argsort(descending=True)]
+        input_var, input_lengths = self._gather(self.src_tokens, self.src_offsets, self.src_lengths, ids)
+        target_var, target_lengths = self._gather(self.tgt_tokens, self.tgt_offsets, self.tgt_lengths, ids)
+        return input_var.to(device), input_lengths, target_var.to(device), target_lengths
+
+    def epoch_batches(self):
+        """the sentence ids of every batch in one epoch, in random order
+        """
+        batches = []
+        for bucket in self.buckets:
+            bucket = bucket[torch.randperm(bucket.numel())]
+            if self.max_tokens is None:
+                batches.extend(bucket.split(self.batch_size))
+            else:
+                batches.extend(self._token_batches(bucket))
+        return [batches[i] for i in torch.randperm(len(batches)).tolist()]
+
+    def _token_batches(self, ids):
+        """splits ids into batches of at most max_tokens padded source + target tokens
+        (a single pair longer than that still gets a batch of its own)
+        """
+        # shortest target first (stable, so still shuffled among equal lengths): batch-mates
+        # then have similar target lengths as well, and the target side needs little padding too
+        ids = ids[torch.sort(self.tgt_lengths[ids], stable=True)[1]]
+        batches = []
+        start = 0
+        max_src = max_tgt = 0
+        for i, (src_length, tgt_length) in enumerate(zip(self.src_lengths[ids].tolist(),
+                                                          self.tgt_lengths[ids].tolist())):
+            max_src, max_tgt = max(max_src, src_length), max(max_tgt, tgt_length)
+            if i > start and (i - start + 1) * (max_src + max_tgt) > self.max_tokens:
+                batches.append(ids[start:i])
+                start = i
+                max_src, max_tgt = src_length, tgt_length
+        batches.append(ids[start:])
+        return batches
+
+    def mean_batch_size(self):
+        """sentences per batch: batch_size, or with max_tokens the average over an epoch's batches.
+        the buckets are split in their stored order, so this draws nothing from the training RNG
+        """
+        if self.max_tokens is None:
+            return self.batch_size
+        batches = [ids for bucket in self.buckets for ids in self._token_batches(bucket)]
+        return sum(len(ids) for ids in batches) / len(batches)
 
-    return input_var, input_lengths, target_var, target_lengths
+    def __iter__(self):
+        """yields batches forever, one shuffled epoch after another
+        """
+        while True:
+            for ids in self.epoch_batches():
+                yield self.get_batch(ids)
+            self.epoch += 1
+            logging.debug('finished training epoch %d', self.epoch)
 
 ######################################################################
 
 
+def lstm_gates(gates, c):
+    """the LSTM update from the pre-activation gates (batch x 4*hidden, in input, forget,
+    cell, output order) and the previous cell state. returns the new h and c
+    """
+    i, f, g, o = gates.chunk(4, 1)
+    c = torch.sigmoid(f) * c + torch.sigmoid(i) * torch.tanh(g)
+    return torch.sigmoid(o) * torch.tanh(c), c
+
+
+def lstm_scan(gates_x, weight_hh, mask, h, c, reverse: bool):
+    """the LSTM time loop, written so it can be TorchScript-compiled (see script_lstm).
+    gates_x holds the input half of the gates for every step (steps x batch x 4*hidden),
+    so each step only needs one matmul for the recurrent half.
+    mask (steps x batch, bool) is False at padded positions: those steps leave the state
+    alone, so with reverse=True every sequence starts at its own last real token.
+    returns the (steps x batch x hidden) outputs, zero at padded positions, and the final h and c
+    """
+    steps = gates_x.size(0)
+    outputs = h.new_zeros([steps, h.size(0), h.size(1)])
+    weight_hh_t = weight_hh.t()
+    for i in range(steps):
+        t = steps - 1 - i if reverse else i
+        h_new, c_new = lstm_gates(gates_x[t] + h.mm(weight_hh_t), c)
+        m = mask[t].unsqueeze(1)
+        h = torch.where(m, h_new, h)
+        c = torch.where(m, c_new, c)
+        outputs[t] = h_new.masked_fill(~m, 0.)
+    return outputs, h, c
+
+
+_lstm_scan = lstm_scan
+
+
+def script_lstm(enabled=True):
+    """switches every LSTM over to the TorchScript-compiled time loop (or back to plain python)
+    """
+    global _lstm_scan
+    _lstm_scan = torch.jit.script(lstm_scan) if enabled else lstm_scan
+
+
+class LSTMCell(nn.Module):
+    """ The parameters of one LSTM direction. The four gate projections are stacked,
+    so the input and the recurrent half of all gates are one matmul each.
+    LSTM runs the steps itself (lstm_scan), so this holds the weights only.
+    """
+    def __init__(self, input_size, hidden_size):
+        super(LSTMCell, self).__init__()
+        self.input_size = input_size
+        self.hidden_size = hidden_size
+        self.weight_ih = nn.Parameter(torch.empty(4 * hidden_size, input_size))
+        self.weight_hh = nn.Parameter(torch.empty(4 * hidden_size, hidden_size))
+        self.bias = nn.Parameter(torch.empty(4 * hidden_size))
+        bound = 1 / hidden_size ** 0.5
+        for weight in self.parameters():
+            nn.init.uniform_(weight, -bound, bound)
+
+
+class LSTM(nn.Module):
+    """ A single-layer, optionally bidirectional LSTM over (seq x batch x input) tensors,
+    a drop-in for nn.LSTM: the state is (h, c), each (num_directions x batch x hidden),
+    and the outputs of the two directions are concatenated.
+    Variable-length batches are given either as lengths or as a PackedSequence.
+    """
+    def __init__(self, input_size, hidden_size, bidirectional=False):
+        super(LSTM, self).__init__()
+        self.input_size = input_size
+        self.hidden_size = hidden_size
+        self.bidirectional = bidirectional
+        self.cells = nn.ModuleList([LSTMCell(input_size, hidden_size) for _ in range(2 if bidirectional else 1)])
+
+    def forward(self, inputs, lengths=None, state=None):
+        packed = isinstance(inputs, PackedSequence)
+        if packed:
+            inputs, lengths = pad_packed_sequence(inputs)
+
+        steps, batch_size = inputs.size(0), inputs.size(1)
+        if lengths is None:
+            mask = torch.ones(steps, batch_size, dtype=torch.bool, device=inputs.device)
+        else:
+            mask = sequence_mask(lengths, steps).t()
+        if state is None:
+            zeros = inputs.new_zeros(len(self.cells), batch_size, self.hidden_size)
+            state = (zeros, zeros)
+
+        outputs, hs, cs = [], [], []
+        for direction, cell in enumerate(self.cells):
+            # the input half of the gates, for all steps in one matmul
+            gates_x = F.linear(inputs, cell.weight_ih, cell.bias)
+            output, h, c = _lstm_scan(gates_x, cell.weight_hh, mask, state[0][direction], state[1][direction],
+                                      direction == 1)
+            outputs.append(output)
+            hs.append(h)
+            cs.append(c)
+
+        outputs = torch.cat(outputs, 2) if len(outputs) > 1 else outputs[0]
+        if packed:
+            outputs = pack_padded_sequence(outputs, lengths, enforce_sorted=False)
+        return outputs, (torch.stack(hs), torch.stack(cs))
+
+
 class EncoderRNN(nn.Module):
     """the class for the enoder RNN
     """
@@ -165,22 +684,45 @@ class EncoderRNN(nn.Module):
         """
         "*** YOUR CODE HERE ***"
         self.embedding = nn.Embedding(input_size, hidden_size)
-        self.rnn = nn.GRU(hidden_size, hidden_size)
+        self.rnn = LSTM(hidden_size, hidden_size, bidirectional=True)
 
 
     def forward(self, input_seqs, input_lengths, hidden=None):
         """runs the forward pass of the encoder
         returns the output and the hidden state
+        the two directions are summed, so the outputs are (seq x batch x hidden)
+        and the final (h, c) is (1 x batch x hidden) each, ready to start the decoder
         """
         "*** YOUR CODE HERE ***"
         embedded = self.embedding(input_seqs)
-        packed = torch.nn.utils.rnn.pack_padded_sequence(embedded, input_lengths)
-        outputs, hidden = self.rnn(packed, hidden)
-        outputs, output_lengths = torch.nn.utils.rnn.pad_packed_sequence(outputs)
-        return outputs, hidden
+        outputs, (h, c) = self.rnn(embedded, input_lengths, hidden)
+        outputs = outputs.view(outputs.size(0), outputs.size(1), 2, self.hidden_size).sum(2)
+        return outputs, (h.sum(0, keepdim=True), c.sum(0, keepdim=True))
 
     def get_initial_hidden_state(self):
-        return torch.zeros(1, 1, self.hidden_size, device=device)
+        zeros = torch.zeros(2, 1, self.hidden_size, device=device)
+        return zeros, zeros
+
+class AttentionMemory:
+    """ The per-batch attention inputs that stay the same at every decoder step:
+    keys: what the decoder states are scored against; (batch x hidden x src_len) for 'dot'
+          and 'general' (the encoder outputs, projected by attn for 'general'), and the
+          encoder half of the 'concat' projection as (batch x src_len x hidden)
+    values: the encoder outputs as (batch x src_len x hidden), ready for bmm
+    pad_mask: (batch x 1 x src_len), True at padded source positions, or None
+    """
+    def __init__(self, keys, values, pad_mask=None):
+        self.keys = keys
+        self.values = values
+        self.pad_mask = pad_mask
+
+    def index_select(self, index):
+        """the memory of the batch rows given by index, e.g. each sentence repeated once per beam hypothesis
+        """
+        return AttentionMemory(self.keys.index_select(0, index),
+                               self.values.index_select(0, index),
+                               None if self.pad_mask is None else self.pad_mask.index_select(0, index))
+
 
 class AttentionLayer(nn.Module):
     def __init__(self, method, hidden_size):
@@ -194,24 +736,60 @@ class AttentionLayer(nn.Module):
 
         elif self.method == 'concat':
             self.attn = nn.Linear(self.hidden_size * 2, hidden_size)
-            self.v = nn.Parameter(torch.FloatTensor(1, hidden_size))
+            self.v = nn.Parameter(torch.randn(1, hidden_size) / hidden_size ** 0.5)
+
+    def forward(self, hidden, encoder_outputs=None, src_mask=None, memory=None):
+        """scores the decoder states against every encoder output at once
+        hidden: (steps x batch x hidden), with steps = 1 when decoding one token at a time
+        encoder_outputs: (src_len x batch x hidden)
+        src_mask: optional (batch x src_len) bool tensor, False at padded source positions
+        memory: the AttentionMemory from precompute(), used instead of encoder_outputs and src_mask
+        returns the attention weights as (batch x steps x src_len)
+        """
+        if memory is None:
+            memory = self.precompute(encoder_outputs, src_mask)
+        attn_energies = self.score_all(hidden, memory)
 
-    def forward(self, hidden, encoder_outputs):
-        max_len = encoder_outputs.size(0)
-        this_batch_size = encoder_outputs.size(1)
+        if memory.pad_mask is not None:
+            attn_energies = attn_energies.masked_fill(memory.pad_mask, float('-inf'))
 
-        attn_energies = Variable(torch.zeros(this_batch_size, max_len))
+        return F.softmax(attn_energies, dim=2)
 
-        for b in range(this_batch_size):
-            
-            for i in range(max_len):
-                h = hidden[:,b].squeeze()
-                attn_energies[b, i] = self.score(h, encoder_outputs[i, b])
+    def precompute(self, encoder_outputs, src_mask=None):
+        """everything about the encoder outputs that attention needs, computed once per batch
+        """
+        values = encoder_outputs.transpose(0, 1).contiguous()
 
-        
-        return F.softmax(attn_energies, dim=0).unsqueeze(1)
+        if self.method == 'dot':
+            keys = values.transpose(1, 2)
+
+        elif self.method == 'general':
+            keys = self.attn(values).transpose(1, 2)
+
+        elif self.method == 'concat':
+            # self.attn(cat(h, e)) = W_h h + (W_e e + b), and the bracketed half only depends on e
+            keys = F.linear(values, self.attn.weight[:, self.hidden_size:], self.attn.bias)
+
+        pad_mask = None if src_mask is None else ~src_mask.unsqueeze(1)
+        return AttentionMemory(keys, values, pad_mask)
+
+    def score_all(self, hidden, memory):
+        """batched version of score(), returns the (batch x steps x src_len) energies
+        """
+        queries = hidden.transpose(0, 1)
+
+        if self.method == 'concat':
+            queries = F.linear(queries, self.attn.weight[:, :self.hidden_size])
+            # (batch x steps x 1 x hidden) + (batch x 1 x src_len x hidden), then dot with v
+            return (queries.unsqueeze(2) + memory.keys.unsqueeze(1)).matmul(self.v.squeeze(0))
+
+        # (batch x steps x hidden) bmm (batch x hidden x src_len) -> (batch x steps x src_len)
+        return queries.bmm(memory.keys)
     
     def score(self, hidden, encoder_output):
+        """scores a single (hidden, encoder_output) pair of vectors.
+        kept as the reference for score_all (see bench.py)
+        """
         
         if self.method == 'dot':
             energy = hidden.dot(encoder_output)
@@ -223,15 +801,34 @@ class AttentionLayer(nn.Module):
             return energy
         
         elif self.method == 'concat':
-            energy = self.attn(torch.cat((hidden, encoder_output), 1))
-            energy = self.v.dot(energy)
+            energy = self.attn(torch.cat((hidden, encoder_output), 0))
+            energy = self.v.squeeze(0).dot(energy)
             return energy
     
 
+def adaptive_cutoffs(counts, coverage=(0.8, 0.95)):
+    """adaptive softmax cluster boundaries from per-index word counts, which must be sorted by
+    descending frequency (as in a frozen Vocab): the head cluster holds the most frequent words
+    that make up coverage[0] of all tokens, the first tail cluster the next ones up to coverage[1]
+    """
+    n_classes = counts.numel()
+    cumulative = counts.double().cumsum(0) / max(int(counts.sum()), 1)
+    cutoffs = []
+    for fraction in coverage:
+        cutoff = int(torch.searchsorted(cumulative, fraction)) + 1
+        if (not cutoffs or cutoff > cutoffs[-1]) and cutoff < n_classes - 1:
+            cutoffs.append(cutoff)
+    return cutoffs or [max(1, n_classes // 2)]
+
+
 class AttnDecoderRNN(nn.Module):
     """the class for the decoder 
+
+    with cutoffs, the output layer is an adaptive softmax (frequent words in a full-size head,
+    rarer ones in smaller tail clusters) instead of one dense Linear over the whole vocab.
+    it only pays off in training; log_prob() still scores every word for decoding
     """
-    def __init__(self, attn_model, hidden_size, output_size, dropout_p=0.1, max_length=MAX_LENGTH):
+    def __init__(self, attn_model, hidden_size, output_size, dropout_p=0.1, max_length=MAX_LENGTH, cutoffs=None):
         super(AttnDecoderRNN, self).__init__()
         self.attn_model = attn_model
         self.hidden_size = hidden_size
@@ -241,159 +838,912 @@ class AttnDecoderRNN(nn.Module):
         # layers
         self.embedding = nn.Embedding(output_size, hidden_size)
         self.embedding_dropout = nn.Dropout(dropout_p)
-        self.rnn = nn.GRU(hidden_size, hidden_size, dropout=dropout_p)
+        self.rnn = LSTM(hidden_size, hidden_size)
         self.attn = AttentionLayer(self.attn_model, hidden_size)
         self.concat = nn.Linear(hidden_size * 2, hidden_size)
-        self.out = nn.Linear(hidden_size, output_size)
+        if cutoffs:
+            self.out = None
+            self.adaptive_out = nn.AdaptiveLogSoftmaxWithLoss(hidden_size, output_size, cutoffs)
+        else:
+            self.out = nn.Linear(hidden_size, output_size)
+            self.adaptive_out = None
         
 
-    def forward(self, input, hidden, encoder_outputs):
+    def forward(self, input, hidden, encoder_outputs=None, src_mask=None, memory=None):
         """runs the forward pass of the decoder
         returns the log_softmax, hidden state, and attn_weights
+        src_mask (batch x src_len, False at padding) keeps attention off padded source positions
+        when decoding step by step, pass memory=self.precompute(encoder_outputs, src_mask)
+        instead of encoder_outputs and src_mask, so the attention keys are only projected once
         
         Dropout (self.dropout) should be applied to the word embeddings.
         """
         
         "*** YOUR CODE HERE ***"
         
-        # Calculate attention weights and apply to encoder outputs
         batch_size = input.size(0)
         embedded = self.embedding_dropout(self.embedding(input)).view(1, batch_size, self.hidden_size)
         
-        rnn_output, hidden = self.rnn(embedded, hidden)
-        
-        attn_weights = self.attn(rnn_output, encoder_outputs)
-        #context vector
-        context = attn_weights.bmm(encoder_outputs.transpose(0, 1)) 
-      
-        concat_input = torch.cat((rnn_output.squeeze(0), context.squeeze(1)), 1)
-        concat_output = torch.tanh(self.concat(concat_input))
+        rnn_output, hidden = self.rnn(embedded, None, hidden)
 
-        
-        output = self.out(concat_output)
+        if memory is None:
+            memory = self.precompute(encoder_outputs, src_mask)
+        concat_output, attn_weights = self.attend(rnn_output, memory)
+        output = self.logits(concat_output.squeeze(0))
 
         # Return final output, hidden state, and attention weights (for visualization)
         return output, hidden, attn_weights
 
+    def forward_sequence(self, inputs, hidden, encoder_outputs=None, src_mask=None, memory=None):
+        """teacher-forced pass over a whole (steps x batch) tensor of decoder inputs:
+        one embedding lookup, one rnn call, and attention for all steps together.
+        returns the (steps x batch x hidden) features that logits() and loss() take,
+        the final hidden state, and the attn_weights
+        """
+        embedded = self.embedding_dropout(self.embedding(inputs))
+        rnn_outputs, hidden = self.rnn(embedded, None, hidden)
+        if memory is None:
+            memory = self.precompute(encoder_outputs, src_mask)
+        features, attn_weights = self.attend(rnn_outputs, memory)
+        return features, hidden, attn_weights
+
+    def precompute(self, encoder_outputs, src_mask=None):
+        """the AttentionMemory for a batch of (src_len x batch x hidden) encoder outputs
+        """
+        return self.attn.precompute(encoder_outputs, src_mask)
+
+    def attend(self, rnn_outputs, memory):
+        """attention and the concat layer on top of (steps x batch x hidden) rnn outputs.
+        returns the (steps x batch x hidden) features and the (batch x steps x src_len) attn_weights
+        """
+        # Calculate attention weights and apply to encoder outputs
+        attn_weights = self.attn(rnn_outputs, memory=memory)
+        #context vector
+        context = attn_weights.bmm(memory.values)
+
+        concat_input = torch.cat((rnn_outputs, context.transpose(0, 1)), 2)
+        return torch.tanh(self.concat(concat_input)), attn_weights
+
+    def logits(self, features):
+        """scores over the whole target vocab for (n x hidden) features: the dense layer's logits,
+        or the adaptive softmax's exact log-probabilities (same argmax and top-k either way)
+        """
+        if self.adaptive_out is not None:
+            with autocast('fp32'):
+                return self.adaptive_out.log_prob(features.float())
+        return self.out(features)
+
+    def predict(self, features):
+        """the most likely word for each of (n x hidden) features. the adaptive softmax only
+        evaluates a tail cluster for the rows whose head prediction falls into it
+        """
+        if self.adaptive_out is not None:
+            with autocast('fp32'):
+                return self.adaptive_out.predict(features.float())
+        return self.out(features).argmax(1)
+
+    def loss(self, features, targets):
+        """mean negative log-likelihood of the targets given (n x hidden) features, in fp32
+        """
+        if self.adaptive_out is not None:
+            # AdaptiveLogSoftmaxWithLoss copies the cluster outputs into a buffer of the input's
+            # dtype, so under bf16 autocast its head and tails would not even agree on one
+            with autocast('fp32'):
+                return self.adaptive_out(features.float(), targets).loss
+        return F.cross_entropy(self.out(features).float(), targets)
+
+    def token_log_probs(self, features, targets):
+        """the log-probability of each of the n targets given (n x hidden) features, in fp32
+        """
+        if self.adaptive_out is not None:
+            with autocast('fp32'):
+                return self.adaptive_out(features.float(), targets).output
+        log_probs = F.log_softmax(self.out(features).float(), dim=1)
+        return log_probs.gather(1, targets.unsqueeze(1)).squeeze(1)
+
     def get_initial_hidden_state(self):
-        return torch.zeros(1, 1, self.hidden_size, device=device)
+        zeros = torch.zeros(1, 1, self.hidden_size, device=device)
+        return zeros, zeros
 
 
 ######################################################################
+# Training instrumentation: wall-clock time per phase of the training loop,
+# token throughput and peak memory, one JSON line per --print_every interval.
+#
+
+def peak_rss_mb():
+    """the peak resident set size of this process so far, None where getrusage is not available
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    # kilobytes on linux, bytes on mac
+    scale = 2 ** 20 if sys.platform == 'darwin' else 2 ** 10
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+class TrainingMetrics:
+    """ Accumulates per-phase wall-clock time and token counts between flush() calls.
+    flush() writes them as one JSON line to filename (if given) and starts a new interval.
+    with profile_iters = (first, last), iterations first..last are also recorded with
+    torch.profiler and written as a chrome trace to profile_file
+    """
+    def __init__(self, filename=None, rank=0, profile_iters=None, profile_file='trace.json'):
+        self.rank = rank
+        self._file = open(filename, 'a', encoding='utf-8') if filename else None
+        self._profile_iters = profile_iters
+        self._profile_file = profile_file
+        self._profiler = None
+        self._reset()
+
+    def _reset(self):
+        self.interval_start = time.perf_counter()
+        self.phase_seconds = collections.defaultdict(float)
+        self.tokens = collections.Counter()
+        self.batches = 0
+        self.step_seconds = []
+
+    def count_update(self, seconds):
+        """records the wall-clock time of one optimizer update (all its accumulated batches)
+        """
+        self.step_seconds.append(seconds)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """times the enclosed block as phase name (and labels it in the profiler trace)
+        """
+        start = time.perf_counter()
+        try:
+            if self._profiler is not None:
+                with torch.profiler.record_function(name):
+                    yield
+            else:
+                yield
+        finally:
+            self.phase_seconds[name] += time.perf_counter() - start
+
+    def count_batch(self, input_batches, input_lengths, target_batches, target_lengths):
+        self.batches += 1
+        self.tokens['sentences'] += len(input_lengths)
+        self.tokens['src_tokens'] += int(sum(input_lengths))
+        self.tokens['src_tokens_padded'] += input_batches.numel()
+        self.tokens['tgt_tokens'] += int(sum(target_lengths))
+        self.tokens['tgt_tokens_padded'] += target_batches.numel()
+
+    def step(self, iter_num):
+        """call at the start of every iteration, it starts and stops the profiler window
+        """
+        if self._profile_iters is None:
+            return
+        first, last = self._profile_iters
+        if iter_num == first:
+            self._profiler = torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU],
+                                                    record_shapes=True, profile_memory=True)
+            self._profiler.__enter__()
+        elif iter_num == last + 1:
+            self._stop_profiler()
+
+    def _stop_profiler(self):
+        if self._profiler is None:
+            return
+        self._profiler.__exit__(None, None, None)
+        self._profiler.export_chrome_trace(self._profile_file)
+        logging.info('wrote the profile of iterations %d-%d to %s', *self._profile_iters, self._profile_file)
+        self._profiler = None
+
+    def flush(self, iter_num, **extra):
+        """ends the current interval: returns its metrics as a dict and writes them out
+        """
+        seconds = time.perf_counter() - self.interval_start
+        record = {'iter': iter_num, 'rank': self.rank, 'time': time.time(), 'interval_sec': seconds}
+        record.update(extra)
+        record['phase_sec'] = dict(self.phase_seconds)
+        record['phase_sec']['other'] = seconds - sum(self.phase_seconds.values())
+        for name, count in self.tokens.items():
+            record[name + '_per_sec'] = count / seconds
+        if self.batches:
+            record['sentences_per_batch'] = self.tokens['sentences'] / self.batches
+            record['src_padding_ratio'] = 1 - self.tokens['src_tokens'] / self.tokens['src_tokens_padded']
+            record['tgt_padding_ratio'] = 1 - self.tokens['tgt_tokens'] / self.tokens['tgt_tokens_padded']
+        if self.step_seconds:
+            record['step_ms'] = sum(self.step_seconds) / len(self.step_seconds) * 1e3
+            record['max_step_ms'] = max(self.step_seconds) * 1e3
+            logging.info('batches: %.1f sentences/batch, padding src:%.1f%% tgt:%.1f%%, step time mean:%.1fms max:%.1fms',
+                         record['sentences_per_batch'], record['src_padding_ratio'] * 100,
+                         record['tgt_padding_ratio'] * 100, record['step_ms'], record['max_step_ms'])
+        record['peak_rss_mb'] = peak_rss_mb()
+        if self._file is not None:
+            self._file.write(json.dumps(record) + '\n')
+            self._file.flush()
+        logging.debug('phase seconds (iter:%d): %s', iter_num,
+                      ' '.join('%s:%.2f' % item for item in sorted(record['phase_sec'].items())))
+        self._reset()
+        return record
+
+    def close(self):
+        self._stop_profiler()
+        if self._file is not None:
+            self._file.close()
+
+
+@contextlib.contextmanager
+def _untimed(name):
+    """the phase() of a training step without TrainingMetrics: times nothing
+    """
+    yield
+
+
+def train(input_batches, input_lengths, target_batches, target_lengths, encoder, decoder, optimizer,
+          teacher_force_ratio=teacher_force_ratio, max_length=MAX_LENGTH, metrics=None, precision='fp32'):
+    """one optimizer update on one batch, returns its loss
+    """
+    return train_update([(input_batches, input_lengths, target_batches, target_lengths)], encoder, decoder, optimizer,
+                        teacher_force_ratio=teacher_force_ratio, metrics=metrics, precision=precision)
 
-def train(input_batches, input_lengths, target_batches, target_lengths, encoder, decoder, optimizer, criterion, batch_size, max_length=MAX_LENGTH):
 
+def train_update(batches, encoder, decoder, optimizer, teacher_force_ratio=teacher_force_ratio, metrics=None,
+                 precision='fp32'):
+    """one optimizer update with gradients accumulated over several
+    (input_batches, input_lengths, target_batches, target_lengths) batches.
+    each batch's loss is weighted by its share of the target tokens, so the update follows
+    the per-token mean loss over all of them however unevenly the batches are filled.
+    returns that mean loss
+    """
     # make sure the encoder and decoder are in training mode so dropout is applied
     encoder.train()
     decoder.train()
-    loss = 0
 
-    "*** YOUR CODE HERE ***"
-    optimizer.zero_grad()
+    phase = metrics.phase if metrics is not None else _untimed
+    with phase('optimizer'):
+        optimizer.zero_grad()
 
-    # same structure as translate below
-    encoder_hidden = encoder.get_initial_hidden_state()
-    encoder_outputs = torch.zeros(max_length, encoder.hidden_size, device=device)
+    n_tokens = [sum(batch[3]) for batch in batches]
+    total_tokens = sum(n_tokens)
+    total_loss = 0.0
+    for batch, batch_tokens in zip(batches, n_tokens):
+        loss = forward_backward(*batch, encoder, decoder, batch_tokens / total_tokens,
+                                teacher_force_ratio=teacher_force_ratio, phase=phase, precision=precision)
+        total_loss += loss * batch_tokens
 
+    if dist.is_available() and dist.is_initialized():
+        with phase('allreduce'):
+            average_gradients(list(encoder.parameters()) + list(decoder.parameters()))
+    with phase('optimizer'):
+        optimizer.step()
+
+    return total_loss / total_tokens
+
+
+def forward_backward(input_batches, input_lengths, target_batches, target_lengths, encoder, decoder, loss_weight=1.0,
+                     teacher_force_ratio=teacher_force_ratio, phase=_untimed, precision='fp32'):
+    """the forward pass and loss of one batch, then backward of loss * loss_weight
+    (adding to whatever gradients are already there). returns the unweighted loss
+    """
+    "*** YOUR CODE HERE ***"
+    batch_size = input_batches.size(1)
+
+    with phase('encoder'), autocast(precision):
+        encoder_outputs, encoder_hidden = encoder(input_batches, input_lengths)
+        src_mask = sequence_mask(input_lengths, encoder_outputs.size(0))
+        memory = decoder.precompute(encoder_outputs, src_mask)
 
-    encoder_outputs, encoder_hidden = encoder(input_batches, input_lengths)
-        
     # prepare decoder
-    decoder_input = torch.tensor([[SOS_index] * batch_size], device=device).transpose(0,1)
-    decoder_hidden = encoder_hidden
     max_target_length = max(target_lengths)
-    all_decoder_outputs = Variable(torch.zeros(max_target_length, batch_size, decoder.output_size))
+    # only the real (non-pad) target positions count towards the loss
+    target_mask = target_batches != PAD_index
+
+    with phase('decoder'), autocast(precision):
+        if random.random() < teacher_force_ratio:
+            # teacher forcing: every decoder input is known up front, so all steps run at once
+            sos = torch.full((1, batch_size), SOS_index, dtype=torch.long, device=device)
+            decoder_inputs = torch.cat((sos, target_batches[:-1]))
+            features, _, _ = decoder.forward_sequence(decoder_inputs, encoder_hidden, memory=memory)
+        else:
+            # feed the decoder its own predictions, one step at a time
+            features = torch.empty(max_target_length, batch_size, decoder.hidden_size, device=device)
+            decoder_input = torch.full((1, batch_size), SOS_index, dtype=torch.long, device=device)
+            decoder_hidden = encoder_hidden
+            for t in range(max_target_length):
+                step_features, decoder_hidden, _ = decoder.forward_sequence(decoder_input, decoder_hidden, memory=memory)
+                features[t] = step_features[0]
+                decoder_input = decoder.predict(step_features[0].detach()).unsqueeze(0)
+
+    with phase('loss'), autocast(precision):
+        #how to account for loss: the output layer is only applied at the non-pad positions.
+        #under bf16 only its matmul runs in bf16, loss() takes the log-softmax in fp32
+        loss = decoder.loss(features[target_mask], target_batches[target_mask])
 
-    
-    for t in range(max_target_length):
-        decoder_output, decoder_hidden, decoder_attn = decoder(
-            decoder_input, decoder_hidden, encoder_outputs
-        )
+    #backpropogation
+    with phase('backward'):
+        (loss * loss_weight).backward()
 
-        all_decoder_outputs[t] = decoder_output
-        decoder_input = target_batches[t] 
+    return loss.item()
 
-    #how to account for loss
-    loss += criterion(all_decoder_outputs, target_batches)
 
-    #backpropogation
-    loss.backward()
-    optimizer.step()
-    
-    return loss.item() 
+def scaled_learning_rate(learning_rate, batch_ratio, scaling='sqrt'):
+    """the learning rate for an effective batch batch_ratio times the size learning_rate was set for
+    """
+    if scaling == 'linear':
+        return learning_rate * batch_ratio
+    if scaling == 'sqrt':
+        return learning_rate * batch_ratio ** 0.5
+    return learning_rate
+
+
+######################################################################
+# Data-parallel training: every worker process runs train() on its own shard
+# and the gradients are averaged over gloo before each optimizer step.
+#
 
+def broadcast_parameters(params):
+    """copies rank 0's parameters to every other worker, so they all start from the same weights
+    """
+    for param in params:
+        dist.broadcast(param.data, src=0)
+
+
+def average_gradients(params):
+    """averages the gradients of params across the workers with a single all_reduce over a flat buffer.
+    a parameter without a gradient (e.g. an adaptive softmax tail cluster no target of this batch
+    fell into) gets a zero one first, so every worker reduces the same buffer layout
+    """
+    for param in params:
+        if param.grad is None:
+            param.grad = torch.zeros_like(param)
+    grads = [param.grad for param in params]
+    flat = torch.cat([grad.reshape(-1) for grad in grads])
+    dist.all_reduce(flat)
+    flat /= dist.get_world_size()
+    offset = 0
+    for grad in grads:
+        grad.copy_(flat[offset:offset + grad.numel()].view_as(grad))
+        offset += grad.numel()
+
+
+def mean_over_workers(value):
+    """the average of a number over all workers, the same on every rank
+    """
+    total = torch.tensor([float(value)], dtype=torch.double)
+    dist.all_reduce(total)
+    return total.item() / dist.get_world_size()
+
+
+def gather_throughput(sentences_per_sec):
+    """collects every worker's sentences/sec, in rank order
+    """
+    rates = [torch.zeros(1) for _ in range(dist.get_world_size())]
+    dist.all_gather(rates, torch.tensor([sentences_per_sec]))
+    return [rate.item() for rate in rates]
 
 
 ######################################################################
 
-def translate(encoder, decoder, sentence, src_vocab, tgt_vocab, target_lengths, batch_size, max_length=MAX_LENGTH):
+def translate(encoder, decoder, sentence, src_vocab, tgt_vocab, max_length=MAX_LENGTH, cache=None, precision='fp32'):
     """
     runs tranlsation, returns the output and attention
+    with a TranslationCache, sentences this model has translated before are not decoded again
     """
+    if cache is not None:
+        key = cache.key(encoder, decoder, ('greedy+attention', max_length, precision), sentence)
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
 
     # switch the encoder and decoder to eval mode so they are not applying dropout
     encoder.eval()
     decoder.eval()
 
-    input_lengths = [len(sentence)]
     input_seqs = [add_indices_from_sentence(src_vocab, sentence)]
-    input_batches = Variable(torch.LongTensor(input_seqs)).transpose(0, 1)
+    input_lengths = [len(input_seqs[0])]
+    input_batches = torch.tensor(input_seqs, device=device).transpose(0, 1)
+
+    with torch.no_grad(), autocast(precision):
+        encoder_outputs, encoder_hidden = encoder(input_batches, input_lengths)
+        memory = decoder.precompute(encoder_outputs, sequence_mask(input_lengths, encoder_outputs.size(0)))
+
+        # prepare decoder
+        decoder_input = torch.tensor([[SOS_index]], device=device)
+        decoder_hidden = encoder_hidden
+        decoded_words = []
+        decoder_attentions = torch.zeros(max_length, input_lengths[0])
+
+        for t in range(max_length):
+            decoder_output, decoder_hidden, decoder_attn = decoder(decoder_input, decoder_hidden, memory=memory)
+            decoder_attentions[t] = decoder_attn.view(-1).cpu()
+            ni = decoder_output.argmax(1).item()
+            if ni == EOS_index:
+                decoded_words.append(EOS_token)
+                break
+            else:
+                decoded_words.append(tgt_vocab.index2word[ni])
+            decoder_input = torch.tensor([[ni]], device=device)
+
+    decoder_attentions = decoder_attentions[:len(decoded_words)]
+    if cache is not None:
+        cache.put(key, (decoded_words, decoder_attentions))
+    return decoded_words, decoder_attentions
 
 
-    encoder_outputs, encoder_hidden = encoder(input_batches, input_lengths)
-        
-    # prepare decoder
-    decoder_input = torch.tensor([[SOS_index] * batch_size], device=device).transpose(0,1)
+######################################################################
+# Batched decoding: sentences are sorted by length and decoded a batch at a time.
+# Every row keeps going until it emits EOS_index, and the batch stops once all rows have.
+#
+
+def reorder_hidden(hidden, index):
+    """picks the rows (batch entries) of a decoder (h, c) state given by index
+    """
+    return tuple(state.index_select(1, index) for state in hidden)
+
+
+def weight_versions(*modules):
+    """the identity and in-place version counter of every parameter and buffer: changes whenever
+    any of them is updated (optimizer step, load_state_dict), and costs nothing like hashing them would.
+    only real parameters and buffers count: the state_dict of a dynamically quantized layer also
+    holds packed weights, dtypes and scales that are rebuilt on every state_dict() call
+    """
+    return [(id(tensor), tensor._version)
+            for module in modules
+            for tensors in (module.named_parameters(), module.named_buffers())
+            for _, tensor in tensors]
+
+
+class EncodedBatch:
+    """ One batch of source sentences after the encoder:
+    ids: the sentences' positions in the list the batch was made from
+    outputs: (src_len x batch x hidden) encoder outputs, both directions summed
+    hidden: the merged final (h, c) of the two directions, to start the decoder with
+    src_mask: (batch x src_len), False at padded source positions
+    """
+    def __init__(self, ids, outputs, hidden, src_mask):
+        self.ids = ids
+        self.outputs = outputs
+        self.hidden = hidden
+        self.src_mask = src_mask
+
+    @classmethod
+    def encode(cls, encoder, sentences, src_vocab, ids):
+        input_batches, input_lengths = src_vocab.encode_batch(sentences)
+        outputs, hidden = encoder(input_batches.to(device), input_lengths)
+        return cls(ids, outputs, hidden, sequence_mask(input_lengths, outputs.size(0)))
+
+
+class SourceEncodings:
+    """ A whole list of source sentences run through the encoder once, in batches of
+    batch_size sentences of similar length. Pass it to translate_sentences, nbest_translate or
+    score_candidates to decode the same sentences again (other beam sizes, n-best lists,
+    rescoring) without re-running the encoder. only valid while the encoder's weights stay unchanged
+    """
+    def __init__(self, encoder, sentences, src_vocab, batch_size=64, precision='fp32'):
+        self.n_sentences = len(sentences)
+        # an encoding's id is its sentence's position in sentences
+        self.ids_by_sentence = {sentence: i for i, sentence in enumerate(sentences)}
+        self.precision = precision
+        self._encoder_versions = weight_versions(encoder)
+        # longest first, so there is little padding in each batch
+        order = sorted(range(len(sentences)), key=lambda i: sentences[i].count(' '), reverse=True)
+        self.batches = []
+        encoder.eval()
+        with torch.no_grad(), autocast(precision):
+            for start in range(0, len(order), batch_size):
+                batch_order = order[start:start + batch_size]
+                self.batches.append(EncodedBatch.encode(encoder, [sentences[i] for i in batch_order], src_vocab,
+                                                        batch_order))
+
+    def __len__(self):
+        return self.n_sentences
+
+    def check(self, encoder, precision):
+        """raises ValueError if encoder is not (or no longer) the encoder these encodings came from,
+        or if they were computed at another precision than the decoder is about to run at
+        """
+        if weight_versions(encoder) != self._encoder_versions:
+            raise ValueError('the source encodings are stale: the encoder weights changed since they were computed')
+        if precision != self.precision:
+            raise ValueError('the source encodings were computed in %s, not %s' % (self.precision, precision))
+
+    def ids_of(self, sentences):
+        """the id of the encoding of each of sentences (the same for repeated sentences).
+        raises ValueError if one of them was not encoded
+        """
+        try:
+            return [self.ids_by_sentence[sentence] for sentence in sentences]
+        except KeyError as e:
+            raise ValueError('no source encoding for "%s"' % e.args[0])
+
+
+def greedy_decode(decoder, encoder_outputs, encoder_hidden, src_mask, max_length=MAX_LENGTH):
+    """decodes a whole batch greedily
+    returns a (batch x steps) tensor of target indices, PAD_index after each row's EOS
+    """
+    batch_size = encoder_outputs.size(1)
+    memory = decoder.precompute(encoder_outputs, src_mask)
+    decoder_input = torch.full((batch_size, 1), SOS_index, dtype=torch.long, device=device)
     decoder_hidden = encoder_hidden
-    max_target_length = max(target_lengths)
-    all_decoder_outputs = Variable(torch.zeros(max_target_length, batch_size, decoder.output_size))
-    decoded_words = []
-    decoder_attentions = torch.zeros(max_length + 1, max_length + 1)
-    
-    for t in range(max_target_length):
-        decoder_output, decoder_hidden, decoder_attn = decoder(
-            decoder_input, decoder_hidden, encoder_outputs
-        )
-        decoder_attentions[t,:decoder_attn.size(2)] += decoder_attn.squeeze(0).squeeze(0).cpu().data
-        topv, topi = decoder_output.data.topk(1)
-        ni = topi[0][0]
-        if ni == EOS_token:
-            decoded_words.append('<EOS>')
+    finished = torch.zeros(batch_size, dtype=torch.bool, device=device)
+    outputs = []
+
+    for t in range(max_length):
+        decoder_output, decoder_hidden, _ = decoder(decoder_input, decoder_hidden, memory=memory)
+        next_tokens = decoder_output.argmax(1).masked_fill(finished, PAD_index)
+        outputs.append(next_tokens)
+        finished |= next_tokens == EOS_index
+        if finished.all():
             break
-        else:
-            decoded_words.append(tgt_vocab.index2word[ni])
-        decoder_input = Variable(torch.LongTensor([[ni]]))
-        
+        decoder_input = next_tokens.unsqueeze(1)
 
-    return decoded_words, decoder_attentions
+    return torch.stack(outputs, 1)
 
-        
-        
 
+def beam_decode(decoder, encoder_outputs, encoder_hidden, src_mask, beam_size, length_penalty=1.0, max_length=MAX_LENGTH):
+    """decodes a whole batch with beam search, keeping beam_size hypotheses per sentence.
+    finished hypotheses are ranked by log_prob / length ** length_penalty
+    returns a (batch x steps) tensor of target indices, PAD_index after each row's EOS
+    """
+    return beam_search(decoder, encoder_outputs, encoder_hidden, src_mask, beam_size, length_penalty, max_length)[0][:, 0]
+
+
+def beam_search(decoder, encoder_outputs, encoder_hidden, src_mask, beam_size, length_penalty=1.0,
+                max_length=MAX_LENGTH, n_best=1):
+    """beam search over a whole batch, returning the n_best (<= beam_size) highest ranked
+    hypotheses of each sentence, best first:
+    a (batch x n_best x steps) tensor of target indices, PAD_index after each hypothesis' EOS,
+    the (batch x n_best x steps) log-prob of each of those tokens (0 at the padding),
+    and the (batch x n_best) scores the hypotheses are ranked by
+    """
+    batch_size = encoder_outputs.size(1)
+
+    # row b * beam_size + k of the flattened batch holds hypothesis k of sentence b.
+    # hypotheses never move between sentences, so the attention memory is projected once
+    # per sentence and only repeated here, not reordered with the backpointers
+    rows = torch.arange(batch_size, device=device).repeat_interleave(beam_size)
+    memory = decoder.precompute(encoder_outputs, src_mask).index_select(rows)
+    decoder_hidden = reorder_hidden(encoder_hidden, rows)
+    decoder_input = torch.full((batch_size * beam_size, 1), SOS_index, dtype=torch.long, device=device)
+
+    # all hypotheses start out identical, so only the first one is live at t=0
+    beam_scores = torch.zeros(batch_size, beam_size, device=device)
+    beam_scores[:, 1:] = float('-inf')
+    hyp_lengths = torch.zeros(batch_size, beam_size, device=device)
+    finished = torch.zeros(batch_size, beam_size, dtype=torch.bool, device=device)
+    beam_offsets = (torch.arange(batch_size, device=device) * beam_size).unsqueeze(1)
+    history = []
+
+    for t in range(max_length):
+        decoder_output, decoder_hidden, _ = decoder(decoder_input, decoder_hidden, memory=memory)
+        # scores add up over the steps, so they are kept in fp32 also under bf16
+        log_probs = F.log_softmax(decoder_output.float(), dim=1).view(batch_size, beam_size, -1)
+        vocab_size = log_probs.size(2)
+
+        # a finished hypothesis can only be extended with PAD, at no cost
+        log_probs = log_probs.masked_fill(finished.unsqueeze(2), float('-inf'))
+        log_probs[:, :, PAD_index] = torch.zeros_like(beam_scores).masked_fill(~finished, float('-inf'))
+
+        scores = (beam_scores.unsqueeze(2) + log_probs).view(batch_size, -1)
+        beam_scores, flat_index = scores.topk(beam_size, dim=1)
+        backpointers = torch.div(flat_index, vocab_size, rounding_mode='floor')
+        tokens = flat_index % vocab_size
+
+        was_finished = finished.gather(1, backpointers)
+        hyp_lengths = hyp_lengths.gather(1, backpointers) + (~was_finished).float()
+        finished = was_finished | (tokens == EOS_index)
+        # the log-prob of the chosen token itself, for n-best lists
+        history.append((tokens, backpointers, log_probs.view(batch_size, -1).gather(1, flat_index)))
+
+        if finished.all():
+            break
+        decoder_hidden = reorder_hidden(decoder_hidden, (backpointers + beam_offsets).view(-1))
+        decoder_input = tokens.view(-1, 1)
+
+    # pick the best hypotheses per sentence and follow the backpointers
+    scores, best = (beam_scores / hyp_lengths.clamp(min=1) ** length_penalty).topk(n_best, dim=1)
+    outputs = []
+    token_log_probs = []
+    for tokens, backpointers, step_log_probs in reversed(history):
+        outputs.append(tokens.gather(1, best))
+        token_log_probs.append(step_log_probs.gather(1, best))
+        best = backpointers.gather(1, best)
+    outputs.reverse()
+    token_log_probs.reverse()
+
+    return torch.stack(outputs, 2), torch.stack(token_log_probs, 2), scores
 
-######################################################################
 
 # Translate (dev/test)set takes in a list of sentences and writes out their transaltes
-def translate_sentences(encoder, decoder, pairs, src_vocab, tgt_vocab, target_lengths, batch_size, max_num_sentences=None, max_length=MAX_LENGTH):
-    output_sentences = []
-    for pair in pairs[:max_num_sentences]:
-        output_words, attentions = translate(encoder, decoder, pair[0], src_vocab, tgt_vocab, target_lengths, batch_size)
-        output_sentence = ' '.join(output_words)
-        output_sentences.append(output_sentence)
+def translate_sentences(encoder, decoder, pairs, src_vocab, tgt_vocab, batch_size=64, beam_size=1,
+                        length_penalty=1.0, max_num_sentences=None, max_length=MAX_LENGTH, cache=None,
+                        precision='fp32', detokenize=False, encodings=None):
+    """translates the source side of pairs in batches of batch_size (greedy if beam_size is 1)
+    the translations are returned in the same order as pairs: with BPE and EOS,
+    or with detokenize as finished sentences (what clean() would make of them)
+    with a TranslationCache, only sentences this model has not translated before
+    (with the same decode settings) are decoded, and each of them only once
+    encodings: SourceEncodings of (at least) these source sentences, to skip running the encoder
+    """
+    encoder.eval()
+    decoder.eval()
+
+    sentences = [pair[0] for pair in pairs[:max_num_sentences]]
+    output_sentences = [None] * len(sentences)
+    todo = list(range(len(sentences)))
+    if cache is not None:
+        settings = ('beam', beam_size, length_penalty, max_length, precision, detokenize)
+        keys = [cache.key(encoder, decoder, settings, sentence) for sentence in sentences]
+        first_seen = {}
+        todo = []
+        for i, key in enumerate(keys):
+            output_sentences[i] = cache.get(key)
+            if output_sentences[i] is None and key not in first_seen:
+                first_seen[key] = i
+                todo.append(i)
+
+    if encodings is None:
+        # each distinct sentence is encoded (and decoded) once
+        encodings = SourceEncodings(encoder, list(collections.OrderedDict.fromkeys(sentences[i] for i in todo)),
+                                    src_vocab, batch_size, precision)
+    else:
+        encodings.check(encoder, precision)
+    # the positions in sentences each encoding is decoded for
+    positions = collections.defaultdict(list)
+    for i, encoding_id in zip(todo, encodings.ids_of([sentences[i] for i in todo])):
+        positions[encoding_id].append(i)
+
+    with torch.no_grad(), autocast(precision):
+        for batch in encodings.batches:
+            if positions.keys().isdisjoint(batch.ids):
+                continue
+            if beam_size > 1:
+                decoded = beam_decode(decoder, batch.outputs, batch.hidden, batch.src_mask,
+                                      beam_size, length_penalty, max_length)
+            else:
+                decoded = greedy_decode(decoder, batch.outputs, batch.hidden, batch.src_mask, max_length)
+
+            if detokenize:
+                translations = tgt_vocab.detokenize_batch(decoded.cpu())
+            else:
+                translations = [' '.join(words) for words in tgt_vocab.decode_batch(decoded.cpu())]
+            for encoding_id, translation in zip(batch.ids, translations):
+                for i in positions.get(encoding_id, ()):
+                    output_sentences[i] = translation
+
+    if cache is not None:
+        for i in todo:
+            cache.put(keys[i], output_sentences[i])
+        for i, key in enumerate(keys):
+            if output_sentences[i] is None:
+                output_sentences[i] = output_sentences[first_seen[key]]
+
     return output_sentences
 
 
+# one scored target sentence, from nbest_translate or score_candidates:
+# translation: the BPE string (with EOS for a finished hypothesis), or the finished sentence with detokenize
+# tokens: its target words, up to and including EOS_token; words missing from the vocab were scored as UNK
+# token_log_probs: the log-prob of each of those tokens; log_prob: their sum
+# score: log_prob / len(tokens) ** length_penalty, what beam search ranks by
+Hypothesis = collections.namedtuple('Hypothesis', ['translation', 'tokens', 'token_log_probs', 'log_prob', 'score'])
+
+
+def nbest_translate(encoder, decoder, pairs, src_vocab, tgt_vocab, n_best, beam_size=None, length_penalty=1.0,
+                    batch_size=64, max_length=MAX_LENGTH, precision='fp32', detokenize=False, encodings=None):
+    """the n_best highest ranked beam search hypotheses for the source side of each of pairs,
+    with a beam of beam_size (n_best if not given). returns a best-first list of Hypothesis per
+    pair, in the same order as pairs. encodings: SourceEncodings of (at least) these source sentences
+    """
+    beam_size = beam_size or n_best
+    if n_best > beam_size:
+        raise ValueError('cannot return %d hypotheses from a beam of %d' % (n_best, beam_size))
+    encoder.eval()
+    decoder.eval()
+
+    sentences = [pair[0] for pair in pairs]
+    if encodings is None:
+        encodings = SourceEncodings(encoder, list(collections.OrderedDict.fromkeys(sentences)), src_vocab,
+                                    batch_size, precision)
+    else:
+        encodings.check(encoder, precision)
+    positions = collections.defaultdict(list)
+    for i, encoding_id in enumerate(encodings.ids_of(sentences)):
+        positions[encoding_id].append(i)
+
+    nbest = [None] * len(sentences)
+    with torch.no_grad(), autocast(precision):
+        for batch in encodings.batches:
+            if positions.keys().isdisjoint(batch.ids):
+                continue
+            decoded, token_log_probs, scores = beam_search(decoder, batch.outputs, batch.hidden, batch.src_mask,
+                                                           beam_size, length_penalty, max_length, n_best)
+            # one row per hypothesis, n_best rows per sentence
+            decoded = decoded.flatten(0, 1).cpu()
+            words = tgt_vocab.decode_batch(decoded)
+            if detokenize:
+                translations = tgt_vocab.detokenize_batch(decoded)
+            else:
+                translations = [' '.join(tokens) for tokens in words]
+            hypotheses = []
+            for translation, tokens, log_probs, score in zip(translations, words,
+                                                             token_log_probs.flatten(0, 1).tolist(),
+                                                             scores.flatten().tolist()):
+                log_probs = log_probs[:len(tokens)]
+                hypotheses.append(Hypothesis(translation, tokens, log_probs, sum(log_probs), score))
+            for row, encoding_id in enumerate(batch.ids):
+                for i in positions.get(encoding_id, ()):
+                    nbest[i] = hypotheses[row * n_best:(row + 1) * n_best]
+    return nbest
+
+
+def score_candidates(encoder, decoder, pairs, src_vocab, tgt_vocab, batch_size=64, length_penalty=1.0,
+                     precision='fp32', encodings=None):
+    """forced decoding: how likely the model finds the target side of each of pairs (a candidate
+    translation, BPE'd, without EOS) given its source side. every source sentence is encoded once,
+    however many candidates it has, and batch_size candidates at a time are scored in a single
+    teacher-forced pass. returns a Hypothesis per pair, in the same order as pairs.
+    encodings: SourceEncodings of (at least) the source sentences of pairs
+    """
+    encoder.eval()
+    decoder.eval()
+
+    if encodings is None:
+        encodings = SourceEncodings(encoder, list(collections.OrderedDict.fromkeys(pair[0] for pair in pairs)),
+                                    src_vocab, batch_size, precision)
+    else:
+        encodings.check(encoder, precision)
+    candidates = collections.defaultdict(list)
+    for i, encoding_id in enumerate(encodings.ids_of([pair[0] for pair in pairs])):
+        candidates[encoding_id].append(i)
+
+    scored = [None] * len(pairs)
+    with torch.no_grad(), autocast(precision):
+        for batch in encodings.batches:
+            # (row of the source in this batch, pair) for every candidate of these sources
+            rows = [(row, i) for row, sentence_id in enumerate(batch.ids) for i in candidates.get(sentence_id, ())]
+            if not rows:
+                continue
+            memory = decoder.precompute(batch.outputs, batch.src_mask)
+            for start in range(0, len(rows), batch_size):
+                chunk = rows[start:start + batch_size]
+                index = torch.tensor([row for row, _ in chunk], device=device)
+                target_batches, target_lengths = tgt_vocab.encode_batch([pairs[i][1] for _, i in chunk])
+                target_batches = target_batches.to(device)
+
+                sos = torch.full((1, len(chunk)), SOS_index, dtype=torch.long, device=device)
+                decoder_inputs = torch.cat((sos, target_batches[:-1]))
+                features, _, _ = decoder.forward_sequence(decoder_inputs, reorder_hidden(batch.hidden, index),
+                                                          memory=memory.index_select(index))
+                # the output layer only runs at the real (non-pad) target positions
+                target_mask = target_batches != PAD_index
+                log_probs = torch.zeros(target_batches.shape, device=device)
+                log_probs[target_mask] = decoder.token_log_probs(features[target_mask], target_batches[target_mask])
+
+                for (_, i), length, token_log_probs in zip(chunk, target_lengths, log_probs.t().tolist()):
+                    token_log_probs = token_log_probs[:length]
+                    log_prob = sum(token_log_probs)
+                    scored[i] = Hypothesis(pairs[i][1], pairs[i][1].split(' ') + [EOS_token], token_log_probs,
+                                           log_prob, log_prob / length ** length_penalty)
+    return scored
+
+
+######################################################################
+# Translation cache: dev sentences, the attention examples and served traffic
+# repeat a lot, so translations are kept per model and decode settings.
+#
+
+class TranslationCache:
+    """ LRU cache of translations, bounded by an estimate of the memory its entries take up.
+    keys are (model id, decode settings, source sentence); the model id is a hash
+    of the weights, so translations from older weights are never returned. they are dropped
+    as soon as a different model uses the cache.
+    with filename, the entries are loaded from and save()d to that file
+    """
+    # rough per-entry overhead of the key tuple and the OrderedDict slot
+    ENTRY_OVERHEAD = 256
+
+    def __init__(self, max_bytes=64 * 2 ** 20, filename=None):
+        self.max_bytes = max_bytes
+        self.filename = filename
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._model_id = None
+        self._model_versions = None
+        if filename is not None and os.path.exists(filename):
+            for key, value in torch.load(filename)['entries']:
+                self._insert(key, value)
+            logging.info('loaded %d cached translations from %s', len(self._entries), filename)
+
+    def model_id(self, *modules):
+        """a hash of the modules' whole state_dicts (quantized weights included). it is only
+        recomputed after the weights changed, which every in-place update (optimizer step,
+        load_state_dict) records in the versions of the parameters and buffers
+        """
+        versions = weight_versions(*modules)
+        if versions != self._model_versions:
+            buffer = io.BytesIO()
+            torch.save([module.state_dict() for module in modules], buffer)
+            model_id = hashlib.sha1(buffer.getbuffer()).hexdigest()
+            with self._lock:
+                if model_id != self._model_id:
+                    stale = [key for key in self._entries if key[0] != model_id]
+                    for key in stale:
+                        self._remove(key)
+                    if stale:
+                        logging.debug('translation cache: dropped %d entries of older weights', len(stale))
+                self._model_id = model_id
+                self._model_versions = versions
+        return self._model_id
+
+    def key(self, encoder, decoder, settings, sentence):
+        # the sentence exactly as decoded: encode_batch splits on single spaces, so sentences that
+        # only differ in whitespace can translate differently
+        return self.model_id(encoder, decoder), settings, sentence
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._insert(key, value)
+
+    def _insert(self, key, value):
+        self._entries[key] = value
+        self.nbytes += self._entry_bytes(key, value)
+        while self.nbytes > self.max_bytes and self._entries:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        self.nbytes -= self._entry_bytes(key, self._entries.pop(key))
+
+    def _entry_bytes(self, key, value):
+        if isinstance(value, str):
+            value_bytes = sys.getsizeof(value)
+        else:
+            # (words, attentions) from translate()
+            words, attentions = value
+            value_bytes = sum(sys.getsizeof(word) for word in words) + attentions.numel() * attentions.element_size()
+        return self.ENTRY_OVERHEAD + sys.getsizeof(key[2]) + value_bytes
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'cache_hits': self.hits,
+                    'cache_misses': self.misses,
+                    'cache_hit_rate': self.hits / lookups if lookups else 0.0,
+                    'cache_entries': len(self._entries),
+                    'cache_mb': self.nbytes / 2 ** 20,
+                    }
+
+    def save(self):
+        if self.filename is None:
+            return
+        with self._lock:
+            entries = list(self._entries.items())
+        atomic_save({'entries': entries}, self.filename)
+        logging.info('saved %d cached translations to %s', len(entries), self.filename)
+
+
 ######################################################################
 # We can translate random sentences  and print out the
 # input, target, and output to make some subjective quality judgements:
 #
 
-def translate_random_sentence(encoder, decoder, pairs, target_lengths, batch_size, src_vocab, tgt_vocab, n=1):
+def translate_random_sentence(encoder, decoder, pairs, src_vocab, tgt_vocab, n=1, cache=None, precision='fp32'):
     for i in range(n):
         pair = random.choice(pairs)
         print('>', pair[0])
         print('=', pair[1])
-        output_words, attentions = translate(encoder, decoder, pair[0], src_vocab, tgt_vocab, target_lengths, batch_size)
+        output_words, attentions = translate(encoder, decoder, pair[0], src_vocab, tgt_vocab,
+                                             cache=cache, precision=precision)
         output_sentence = ' '.join(output_words)
         print('<', output_sentence)
         print('')
@@ -401,15 +1751,23 @@ def translate_random_sentence(encoder, decoder, pairs, target_lengths, batch_siz
 
 ######################################################################
 
-def show_attention(input_sentence, output_words, attentions):
+def show_attention(input_sentence, output_words, attentions, filename=None):
     """visualize the attention mechanism. And save it to a file. 
     Plots should look roughly like this: https://i.stack.imgur.com/PhtQi.png
     You plots should include axis labels and a legend.
     you may want to use matplotlib.
+
+    with filename the plot is written there through the non-interactive Agg backend,
+    which needs no display; otherwise it is shown in a window.
+    matplotlib is only imported here, so nothing else pays for its import time
     """
-    
+    import matplotlib
+    if filename is not None:
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import matplotlib.ticker as ticker
+
     "*** YOUR CODE HERE ***"
-    #raise NotImplementedError
     fig = plt.figure()
     ax = fig.add_subplot(111)
     cax = ax.matshow(attentions.numpy(), cmap='bone')
@@ -423,18 +1781,46 @@ def show_attention(input_sentence, output_words, attentions):
     ax.xaxis.set_major_locator(ticker.MultipleLocator(1))
     ax.yaxis.set_major_locator(ticker.MultipleLocator(1))
 
-    plt.show()
-    plt.close()
+    if filename is None:
+        plt.show()
+    else:
+        fig.savefig(filename, bbox_inches='tight')
+    plt.close(fig)
 
 
+# the sentences whose attention is plotted at the end of training (and by default by the plot command)
+ATTENTION_EXAMPLES = ["on p@@ eu@@ t me faire confiance .",
+                      "j en suis contente .",
+                      "vous etes tres genti@@ ls .",
+                      "c est mon hero@@ s "]
 
 
-def translate_and_show_attention(input_sentence, encoder1, decoder1, src_vocab, tgt_vocab, target_lengths, batch_size):
+def translate_and_show_attention(input_sentence, encoder1, decoder1, src_vocab, tgt_vocab, cache=None,
+                                 precision='fp32', filename=None):
     output_words, attentions = translate(
-        encoder1, decoder1, input_sentence, src_vocab, tgt_vocab, target_lengths, batch_size)
+        encoder1, decoder1, input_sentence, src_vocab, tgt_vocab, cache=cache, precision=precision)
     print('input =', input_sentence)
     print('output =', ' '.join(output_words))
-    show_attention(input_sentence, output_words, attentions)
+    show_attention(input_sentence, output_words, attentions, filename)
+
+
+def plot_attention_examples(encoder, decoder, src_vocab, tgt_vocab, sentences, plot_dir, cache=None,
+                            precision='fp32'):
+    """writes the attention plot of each sentence to plot_dir/attention_<i>.png
+    """
+    os.makedirs(plot_dir, exist_ok=True)
+    for i, sentence in enumerate(sentences):
+        filename = os.path.join(plot_dir, 'attention_%d.png' % i)
+        translate_and_show_attention(sentence, encoder, decoder, src_vocab, tgt_vocab,
+                                     cache=cache, precision=precision, filename=filename)
+        logging.info('attention plot for "%s" written to %s', sentence, filename)
+
+
+def write_lines(filename, lines, buffer_size=2 ** 20):
+    """writes lines to filename through one large write buffer, not one write per line
+    """
+    with open(filename, 'wt', encoding='utf-8', buffering=buffer_size) as outf:
+        outf.writelines(line + '\n' for line in lines)
 
 
 def clean(strx):
@@ -446,9 +1832,385 @@ def clean(strx):
 
 
 ######################################################################
+# Dev BLEU. The references never change, so they are cleaned, tokenized and
+# turned into id arrays once; scoring then only has to process the candidates.
+#
+
+class BleuScorer:
+    """ Corpus BLEU against a fixed list of references (one per sentence), computed
+    the same way as nltk's corpus_bleu with its defaults: uniform weights up to
+    max_n-grams, clipped n-gram counts, the brevity penalty and no smoothing.
+    N-grams are counted with array ops: every n-gram gets an integer key and
+    the clipped matches come from comparing the unique (sentence, key) counts
+    of the candidates with those of the references.
+    """
+    def __init__(self, references, max_n=4):
+        self.max_n = max_n
+        references = [clean(ref).split() for ref in references]
+        # id 0 is left for candidate tokens that never appear in a reference
+        self.token_ids = {}
+        for ref in references:
+            for token in ref:
+                self.token_ids.setdefault(token, len(self.token_ids) + 1)
+        self.ref_ids, self.ref_sentences = self._encode(references)
+        self.ref_lengths = torch.tensor([len(ref) for ref in references], dtype=torch.long)
+
+    def _encode(self, sentences):
+        ids = [self.token_ids.get(token, 0) for sentence in sentences for token in sentence]
+        sentence_ids = [i for i, sentence in enumerate(sentences) for _ in sentence]
+        return torch.tensor(ids, dtype=torch.long), torch.tensor(sentence_ids, dtype=torch.long)
+
+    def score(self, translated_sentences, detokenized=False):
+        """BLEU of decoded sentences (with BPE and EOS, as from translate_sentences,
+        or already detokenized) against the first len(translated_sentences) references
+        """
+        if not detokenized:
+            translated_sentences = map(clean, translated_sentences)
+        return self.score_tokens([sent.split() for sent in translated_sentences])
+
+    def score_tokens(self, hypotheses):
+        n_sentences = len(hypotheses)
+        if n_sentences == 0:
+            return 0.0
+        hyp_ids, hyp_sentences = self._encode(hypotheses)
+        hyp_lengths = torch.tensor([len(hyp) for hyp in hypotheses], dtype=torch.long)
+        in_range = self.ref_sentences < n_sentences
+        ref_ids = self.ref_ids[in_range]
+
+        ids = torch.cat([ref_ids, hyp_ids])
+        # the candidates get their own sentence ids so no n-gram spans both sides
+        sentences = torch.cat([self.ref_sentences[in_range], hyp_sentences + n_sentences])
+        is_hyp = torch.arange(ids.numel()) >= ref_ids.numel()
+        n_types = len(self.token_ids) + 1
+
+        log_precision = 0.0
+        keys = ids
+        for n in range(1, self.max_n + 1):
+            if n > 1:
+                # the key of the n-gram starting at i extends that of the (n-1)-gram at i,
+                # renumbered densely so the keys never overflow
+                keys = torch.unique(keys[:-1] * n_types + ids[n - 1:], return_inverse=True)[1]
+            n_ngrams = keys.numel()
+            if n_ngrams == 0:
+                return 0.0
+            valid = sentences[:n_ngrams] == sentences[n - 1:]
+            sentence_keys = (sentences[:n_ngrams] % n_sentences) * (int(keys.max()) + 1) + keys
+
+            hyp_keys, hyp_counts = torch.unique(sentence_keys[valid & is_hyp[:n_ngrams]], return_counts=True)
+            ref_keys, ref_counts = torch.unique(sentence_keys[valid & ~is_hyp[:n_ngrams]], return_counts=True)
+            if hyp_keys.numel() == 0 or ref_keys.numel() == 0:
+                return 0.0
+            pos = torch.searchsorted(ref_keys, hyp_keys).clamp(max=ref_keys.numel() - 1)
+            matched_counts = torch.where(ref_keys[pos] == hyp_keys, ref_counts[pos], torch.zeros_like(pos))
+            numerator = int(torch.minimum(hyp_counts, matched_counts).sum())
+            if numerator == 0:
+                return 0.0
+            # like nltk, a sentence too short for any n-gram still counts 1 in the denominator
+            denominator = int((hyp_lengths - n + 1).clamp(min=1).sum())
+            log_precision += math.log(numerator / denominator) / self.max_n
+
+        hyp_length = int(hyp_lengths.sum())
+        ref_length = int(self.ref_lengths[:n_sentences].sum())
+        brevity_penalty = 1.0 if hyp_length > ref_length else math.exp(1 - ref_length / hyp_length)
+        return brevity_penalty * math.exp(log_precision)
+
+
+def dev_eval_worker(args, model_config, src_vocab, tgt_vocab, dev_pairs, jobs):
+    """the body of the DevEvaluator process: scores whatever weights arrive on jobs
+    """
+    torch.set_num_threads(args.eval_threads)
+    if args.torchscript:
+        script_lstm()
+    encoder, decoder = make_model(model_config, src_vocab, tgt_vocab)
+    scorer = BleuScorer([pair[1] for pair in dev_pairs])
+
+    stop = False
+    while not stop:
+        job = jobs.get()
+        # only the newest weights are worth scoring, skip anything older still queued
+        while job is not None:
+            try:
+                newer = jobs.get_nowait()
+            except queue.Empty:
+                break
+            if newer is None:
+                stop = True
+                break
+            logging.debug('dev evaluation skipped the weights from iter %d', job[0])
+            job = newer
+        if job is None:
+            return
+
+        iter_num, enc_state, dec_state = job
+        encoder.load_state_dict(enc_state)
+        decoder.load_state_dict(dec_state)
+        start = time.time()
+        translated_sentences = translate_sentences(encoder, decoder, dev_pairs, src_vocab, tgt_vocab,
+                                                   batch_size=args.decode_batch_size,
+                                                   beam_size=args.beam_size,
+                                                   length_penalty=args.length_penalty,
+                                                   precision=args.precision,
+                                                   detokenize=True)
+        logging.info('Dev BLEU score (iter:%d): %.2f (evaluated in %.1fs)',
+                     iter_num, scorer.score(translated_sentences, detokenized=True), time.time() - start)
+
+
+class DevEvaluator:
+    """ Runs dev evaluation in a separate process so training does not wait for it.
+    submit() hands the worker a copy of the current weights; the worker always
+    scores the newest weights it has been given and drops older ones.
+    """
+    def __init__(self, args, model_config, src_vocab, tgt_vocab, dev_pairs):
+        ctx = mp.get_context('spawn')
+        self._jobs = ctx.Queue()
+        self._process = ctx.Process(target=dev_eval_worker, name='dev-eval', daemon=True,
+                                    args=(args, model_config, src_vocab, tgt_vocab, dev_pairs, self._jobs))
+        self._process.start()
+
+    def submit(self, iter_num, encoder, decoder):
+        # copies, so the worker does not see the weights change under it while training continues
+        self._jobs.put((iter_num,
+                        {key: value.detach().clone() for key, value in encoder.state_dict().items()},
+                        {key: value.detach().clone() for key, value in decoder.state_dict().items()}))
+
+    def close(self):
+        """waits for the pending evaluation (if any) to finish
+        """
+        self._jobs.put(None)
+        self._process.join()
+
+
+######################################################################
+# Checkpointing: the training loop only pays for copying the state into a
+# reusable snapshot buffer, the actual write happens on a background thread.
+#
+
+def atomic_save(obj, filename):
+    """torch.save to a temporary file, then rename it into place,
+    so an interrupted run never leaves a truncated file behind
+    """
+    tmp_filename = filename + '.tmp'
+    torch.save(obj, tmp_filename)
+    os.replace(tmp_filename, filename)
+
+
+def snapshot_state(state, buffer=None):
+    """copies every tensor of a (nested) state dict, reusing the tensors of an
+    earlier snapshot (buffer) wherever the shape and dtype still match
+    """
+    if torch.is_tensor(state):
+        if torch.is_tensor(buffer) and buffer.shape == state.shape and buffer.dtype == state.dtype:
+            return buffer.copy_(state)
+        return state.detach().clone()
+    if isinstance(state, dict):
+        buffer = buffer if isinstance(buffer, dict) else {}
+        return {key: snapshot_state(value, buffer.get(key)) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        buffer = buffer if isinstance(buffer, (list, tuple)) and len(buffer) == len(state) else [None] * len(state)
+        return type(state)(snapshot_state(value, old) for value, old in zip(state, buffer))
+    return state
+
+
+class CheckpointWriter:
+    """ Writes checkpoints on a background thread.
+    save() snapshots the state into a buffer that is reused from one checkpoint
+    to the next and returns; the file is then written atomically in the
+    background. Only the last keep checkpoints written are kept on disk.
+    """
+    def __init__(self, keep=None):
+        self.keep = keep
+        self.written = collections.deque()
+        self._buffer = None
+        self._error = None
+        self._idle = threading.Event()
+        self._idle.set()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='checkpoint-writer', daemon=True)
+        self._thread.start()
+
+    def save(self, state, filename):
+        start = time.time()
+        # the snapshot buffer is reused, so the previous checkpoint has to be on disk first
+        self._idle.wait()
+        waited = time.time() - start
+        self._check_error()
+        self._buffer = snapshot_state(state, self._buffer)
+        self._idle.clear()
+        self._queue.put((self._buffer, filename))
+        logging.debug('checkpoint %s: training stalled for %.3fs (%.3fs waiting for the previous write)',
+                      filename, time.time() - start, waited)
+
+    def close(self):
+        """waits for the pending checkpoint (if any) to be written and stops the thread
+        """
+        self._queue.put(None)
+        self._thread.join()
+        self._check_error()
+
+    def _check_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            state, filename = item
+            try:
+                start = time.time()
+                atomic_save(state, filename)
+                self.written.append(filename)
+                while self.keep is not None and len(self.written) > self.keep:
+                    old_filename = self.written.popleft()
+                    if os.path.exists(old_filename):
+                        os.remove(old_filename)
+                logging.debug('wrote checkpoint to %s in %.3fs', filename, time.time() - start)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._idle.set()
+
+
+def vocab_fingerprint(vocabs):
+    """a hash of the words of both vocab states in {'src_vocab', 'tgt_vocab'}, in index order,
+    which is what fixes every index a model was trained on
+    """
+    words = vocabs['src_vocab']['words'] + '\n\n' + vocabs['tgt_vocab']['words']
+    return hashlib.sha1(words.encode('utf-8')).hexdigest()[:16]
+
+
+def save_vocabs(src_vocab, tgt_vocab, directory='.'):
+    """writes both vocabs to the side file that checkpoints refer to. it is named after the
+    vocab fingerprint, so runs with other vocabs in the same directory do not overwrite it.
+    returns the file name (relative to directory) and the fingerprint
+    """
+    vocabs = {'src_vocab': src_vocab.to_state(),
+              'tgt_vocab': tgt_vocab.to_state(),
+              }
+    fingerprint = vocab_fingerprint(vocabs)
+    vocab_file = 'vocab_%s.pt' % fingerprint
+    atomic_save(vocabs, os.path.join(directory, vocab_file))
+    return vocab_file, fingerprint
+
+
+def load_side_vocabs(state, filename):
+    """adds the vocabs of the checkpoint state (loaded from filename) from its side file,
+    unless it carries them itself. raises ValueError if the side file holds other vocabs
+    than the checkpoint was trained with (checkpoints from before fingerprints are not checked)
+    """
+    if 'src_vocab' in state:
+        return state
+    vocab_filename = os.path.join(os.path.dirname(filename), state['vocab_file'])
+    vocabs = torch.load(vocab_filename)
+    if 'vocab_fingerprint' in state and vocab_fingerprint(vocabs) != state['vocab_fingerprint']:
+        raise ValueError('%s does not hold the vocabs %s was trained with' % (vocab_filename, filename))
+    state.update(vocabs)
+    return state
+
+
+def load_checkpoint(filename):
+    """loads a state_*.pt checkpoint together with the vocabs from its side file
+    (older checkpoints carry the vocabs themselves)
+    """
+    return load_side_vocabs(torch.load(filename), filename)
+
+
+def make_model(model_config, src_vocab, tgt_vocab):
+    """creates a freshly initialized encoder and decoder as described by model_config
+    (the dict checkpoints store under 'model_config')
+    """
+    encoder = EncoderRNN(src_vocab.n_words, model_config['hidden_size']).to(device)
+    decoder = AttnDecoderRNN(model_config['attn_model'], model_config['hidden_size'], tgt_vocab.n_words,
+                             dropout_p=0.1, cutoffs=model_config.get('cutoffs')).to(device)
+    return encoder, decoder
+
+
+def checkpoint_model_config(state):
+    """the model_config of a checkpoint state. checkpoints without one predate the switch
+    from GRU to LSTM, so their weights cannot be loaded into the current model at all
+    """
+    if 'model_config' not in state:
+        raise ValueError('checkpoint has no model_config: it was written by a GRU-based version of '
+                         'this code and cannot be loaded into the current LSTM model')
+    return state['model_config']
+
+
+def build_model(state):
+    """creates the encoder and decoder a checkpoint was trained with and loads its weights.
+    returns encoder, decoder, src_vocab, tgt_vocab
+    """
+    src_vocab = Vocab.from_state(state['src_vocab'])
+    tgt_vocab = Vocab.from_state(state['tgt_vocab'])
+
+    encoder, decoder = make_model(checkpoint_model_config(state), src_vocab, tgt_vocab)
+    encoder.load_state_dict(state['enc_state'])
+    decoder.load_state_dict(state['dec_state'])
+    return encoder, decoder, src_vocab, tgt_vocab
+
+
+EXPORT_FORMAT = 'seq2seq-export-1'
+
+
+def export_model(filename, encoder, decoder, src_vocab, tgt_vocab, info=None):
+    """writes an inference-only model (e.g. from quantize.py) to one file: the vocabs, and the
+    encoder and decoder pickled whole, so a quantized decoder keeps its quantized layers.
+    the modules are not TorchScript-serialized: decoding drives them from python (AttentionMemory,
+    the adaptive head, beam search), so loading an export needs this module just like a checkpoint
+    """
+    package = {'format': EXPORT_FORMAT,
+               'src_vocab': src_vocab.to_state(),
+               'tgt_vocab': tgt_vocab.to_state(),
+               'info': info or {},
+               }
+    package['encoder'] = encoder
+    package['decoder'] = decoder
+    atomic_save(package, filename)
+
+
+def load_pickled(filename):
+    """torch.load of a file that may hold whole pickled modules (an export): newer torch only
+    loads those with weights_only=False, older torch (before 1.13) has no such argument
+    """
+    if 'weights_only' in inspect.signature(torch.load).parameters:
+        return torch.load(filename, weights_only=False)
+    return torch.load(filename)
+
+
+def load_model(filename):
+    """loads either a state_*.pt checkpoint or a file written by export_model()
+    returns encoder, decoder, src_vocab, tgt_vocab, in eval mode
+    """
+    package = load_pickled(filename)
+    if package.get('format') != EXPORT_FORMAT:
+        encoder, decoder, src_vocab, tgt_vocab = build_model(load_side_vocabs(package, filename))
+    else:
+        encoder = package['encoder'].to(device)
+        decoder = package['decoder'].to(device)
+        src_vocab = Vocab.from_state(package['src_vocab'])
+        tgt_vocab = Vocab.from_state(package['tgt_vocab'])
+    encoder.eval()
+    decoder.eval()
+    return encoder, decoder, src_vocab, tgt_vocab
+
+
+######################################################################
+
+def add_decode_arguments(ap):
+    ap.add_argument('--decode_batch_size', default=64, type=int,
+                    help='number of sentences decoded together')
+    ap.add_argument('--beam_size', default=1, type=int,
+                    help='beam width (1 means greedy decoding)')
+    ap.add_argument('--length_penalty', default=1.0, type=float,
+                    help='beam search ranks finished hypotheses by log_prob / length ** length_penalty')
+    ap.add_argument('--precision', default='fp32', choices=PRECISIONS,
+                    help='bf16 runs the model under CPU autocast (in training, the loss and optimizer state stay fp32)')
+    ap.add_argument('--torchscript', action='store_true',
+                    help='run the LSTM time loop TorchScript-compiled')
 
-def main():
-    ap = argparse.ArgumentParser()
+
+def add_train_arguments(ap):
     ap.add_argument('--hidden_size', default=256, type=int,
                     help='hidden size of encoder/decoder, also word vector size')
     ap.add_argument('--n_iters', default=100000, type=int,
@@ -457,8 +2219,14 @@ def main():
                     help='print loss info every this many training examples')
     ap.add_argument('--checkpoint_every', default=10000, type=int,
                     help='write out checkpoint every this many training examples')
-    ap.add_argument('--initial_learning_rate', default=0.001, type=int,
-                    help='initial learning rate')
+    ap.add_argument('--initial_learning_rate', default=0.001, type=float,
+                    help='initial learning rate, for a batch of --lr_reference_batch sentences')
+    ap.add_argument('--lr_reference_batch', default=8, type=int,
+                    help='effective batch size (sentences per update, over all workers) that --initial_learning_rate is meant for')
+    ap.add_argument('--lr_scaling', default='sqrt', choices=['none', 'linear', 'sqrt'],
+                    help='how the learning rate follows the effective batch size relative to --lr_reference_batch')
+    ap.add_argument('--teacher_force_ratio', default=teacher_force_ratio, type=float,
+                    help='fraction of training batches decoded with teacher forcing (the rest feed back the model\'s own predictions)')
     ap.add_argument('--src_lang', default='fr',
                     help='Source (input) language code, e.g. "fr"')
     ap.add_argument('--tgt_lang', default='en',
@@ -473,107 +2241,452 @@ def main():
                     help='test file. each line should have a source sentence,' +
                          'followed by "|||", followed by a target sentence' +
                          ' (for test, target is ignored)')
+    ap.add_argument('--corpus_cache_dir', default='.corpus_cache',
+                    help='directory for the tokenized training corpus cache (keyed by file hash and mtime)')
     ap.add_argument('--out_file', default='out.txt',
                     help='output file for test translations')
     ap.add_argument('--load_checkpoint', nargs=1,
                     help='checkpoint file to start from')
-
-    args = ap.parse_args()
-
-    batch_size = 8
-
+    ap.add_argument('--keep_checkpoints', default=5, type=int,
+                    help='number of most recent checkpoints to keep on disk')
+    ap.add_argument('--min_count', default=1, type=int,
+                    help='words seen fewer times than this in training are mapped to ' + UNK_token)
+    ap.add_argument('--max_vocab_size', default=None, type=int,
+                    help='keep only this many of the most frequent words per language')
+    ap.add_argument('--batch_size', default=8, type=int,
+                    help='number of sentence pairs per training batch')
+    ap.add_argument('--max_tokens', default=None, type=int,
+                    help='build batches up to this many source + target tokens (padding included) '
+                         'instead of --batch_size sentences')
+    ap.add_argument('--accumulate_steps', default=1, type=int,
+                    help='batches whose gradients are accumulated into each optimizer update')
+    ap.add_argument('--bucket_width', default=1, type=int,
+                    help='training pairs whose source lengths fall in the same bucket of this width are batched together')
+    ap.add_argument('--attn_model', default='general', choices=['dot', 'general', 'concat'],
+                    help='attention scoring method')
+    ap.add_argument('--output_head', default='dense', choices=['dense', 'adaptive'],
+                    help='decoder output layer: a dense softmax over the whole target vocab, or an adaptive '
+                         'softmax with clusters cut from the target word frequencies (cheaper for large vocabs)')
+    ap.add_argument('--workers', default=1, type=int,
+                    help='number of data-parallel training processes (gradients are synced over gloo)')
+    ap.add_argument('--threads_per_worker', default=None, type=int,
+                    help='intra-op threads per training process (default: cores / workers)')
+    ap.add_argument('--master_port', default=29500, type=int,
+                    help='local TCP port the data-parallel workers rendezvous on')
+    ap.add_argument('--seed', default=None, type=int,
+                    help='random seed (each worker adds its rank)')
+    ap.add_argument('--foreground_eval', action='store_true',
+                    help='evaluate dev BLEU in the training process instead of a background process')
+    ap.add_argument('--eval_threads', default=1, type=int,
+                    help='intra-op threads of the background dev evaluation process')
+    ap.add_argument('--translation_cache_mb', default=64, type=float,
+                    help='memory bound of the translation cache used for dev/test translation (0 disables it)')
+    ap.add_argument('--translation_cache_file', default=None,
+                    help='file the translation cache is loaded from and saved to at the end of training')
+    ap.add_argument('--metrics_file', default=None,
+                    help='append per-phase timings, tokens/sec and peak RSS to this JSONL file every print_every '
+                         'iterations (one file per worker, suffixed with its rank, when data parallel)')
+    ap.add_argument('--profile_iters', default=None, type=int, nargs=2, metavar=('FIRST', 'LAST'),
+                    help='record iterations FIRST..LAST with torch.profiler')
+    ap.add_argument('--profile_file', default='trace.json',
+                    help='chrome trace file the --profile_iters window is written to')
+    ap.add_argument('--plot_dir', default='attention_plots',
+                    help='directory the attention plots of a few examples are written to after training '
+                         '(empty to skip them)')
+    add_decode_arguments(ap)
+
+
+def run_train(args):
     # process the training, dev, test files
 
     # Create vocab from training data, or load if checkpointed
-    # also set iteration 
+    train_corpus = load_corpus(args.train_file, args.corpus_cache_dir)
     if args.load_checkpoint is not None:
-        state = torch.load(args.load_checkpoint[0])
-        iter_num = state['iter_num']
-        src_vocab = state['src_vocab']
-        tgt_vocab = state['tgt_vocab']
+        state = load_checkpoint(args.load_checkpoint[0])
+        src_vocab = Vocab.from_state(state['src_vocab'])
+        tgt_vocab = Vocab.from_state(state['tgt_vocab'])
     else:
-        iter_num = 0
+        state = None
         src_vocab, tgt_vocab = make_vocabs(args.src_lang,
                                            args.tgt_lang,
-                                           args.train_file)
+                                           train_corpus)
+        src_vocab.freeze(args.min_count, args.max_vocab_size)
+        tgt_vocab.freeze(args.min_count, args.max_vocab_size)
+
+    if state is not None:
+        # a resumed run keeps the architecture it was started with
+        model_config = checkpoint_model_config(state)
+    else:
+        model_config = {'hidden_size': args.hidden_size,
+                        'attn_model': args.attn_model,
+                        'cutoffs': None,
+                        }
+        if args.output_head == 'adaptive':
+            model_config['cutoffs'] = adaptive_cutoffs(tgt_vocab.index_counts())
+            logging.info('adaptive softmax cutoffs: %s (target vocab: %d words)', model_config['cutoffs'], tgt_vocab.n_words)
+
+    if args.workers > 1:
+        # tensors passed to the workers go through shared memory, so the corpus is not copied
+        mp.spawn(train_worker, args=(args, model_config, train_corpus, src_vocab, tgt_vocab, state),
+                 nprocs=args.workers)
+    else:
+        train_worker(0, args, model_config, train_corpus, src_vocab, tgt_vocab, state)
+
+
+def load_for_inference(args):
+    """the model of args.checkpoint (a checkpoint or an exported model) for the translate/eval/plot commands
+    """
+    if args.torchscript:
+        script_lstm()
+    return load_model(args.checkpoint)
+
+
+def read_pairs(in_file):
+    """the lines of in_file (- for stdin) as pairs: [source] for a plain line, [source, target] for source|||target
+    """
+    infile = sys.stdin if in_file == '-' else open(in_file, encoding='utf-8')
+    with infile:
+        return [[side.strip() for side in line.split('|||')] for line in infile]
+
+
+def write_output(out_file, lines):
+    if out_file == '-':
+        sys.stdout.writelines(line + '\n' for line in lines)
+        sys.stdout.flush()
+    else:
+        write_lines(out_file, lines)
 
-    encoder = EncoderRNN(src_vocab.n_words, args.hidden_size).to(device)
-    decoder = AttnDecoderRNN(args.hidden_size, tgt_vocab.n_words, dropout_p=0.1).to(device)
+
+def run_translate(args):
+    encoder, decoder, src_vocab, tgt_vocab = load_for_inference(args)
+    # plain source sentences, or source|||target pairs whose target is ignored
+    pairs = read_pairs(args.in_file)
+    start = time.time()
+    translated = translate_sentences(encoder, decoder, pairs, src_vocab, tgt_vocab,
+                                     batch_size=args.decode_batch_size,
+                                     beam_size=args.beam_size,
+                                     length_penalty=args.length_penalty,
+                                     precision=args.precision,
+                                     detokenize=True)
+    write_output(args.out_file, translated)
+    logging.info('translated %d sentences in %.1fs', len(translated), time.time() - start)
+
+
+def run_nbest(args):
+    encoder, decoder, src_vocab, tgt_vocab = load_for_inference(args)
+    pairs = read_pairs(args.in_file)
+    start = time.time()
+    nbest = nbest_translate(encoder, decoder, pairs, src_vocab, tgt_vocab, args.n_best,
+                            beam_size=max(args.beam_size, args.n_best),
+                            length_penalty=args.length_penalty,
+                            batch_size=args.decode_batch_size,
+                            precision=args.precision,
+                            detokenize=args.detokenize)
+    write_output(args.out_file, (json.dumps({'source': pair[0],
+                                             'hypotheses': [hypothesis._asdict() for hypothesis in hypotheses]},
+                                            ensure_ascii=False)
+                                 for pair, hypotheses in zip(pairs, nbest)))
+    logging.info('wrote %d-best lists of %d sentences in %.1fs', args.n_best, len(pairs), time.time() - start)
+
+
+def run_score(args):
+    encoder, decoder, src_vocab, tgt_vocab = load_for_inference(args)
+    pairs = read_pairs(args.in_file)
+    if any(len(pair) != 2 for pair in pairs):
+        raise ValueError('%s: every line must be a source|||candidate pair' % args.in_file)
+    start = time.time()
+    scored = score_candidates(encoder, decoder, pairs, src_vocab, tgt_vocab,
+                              batch_size=args.decode_batch_size,
+                              length_penalty=args.length_penalty,
+                              precision=args.precision)
+    write_output(args.out_file, (json.dumps(hypothesis._asdict(), ensure_ascii=False) for hypothesis in scored))
+    logging.info('scored %d candidates in %.1fs', len(pairs), time.time() - start)
+
+
+def run_eval(args):
+    encoder, decoder, src_vocab, tgt_vocab = load_for_inference(args)
+    pairs = split_lines(args.dev_file)
+    scorer = BleuScorer([pair[1] for pair in pairs])
+    start = time.time()
+    # the dev set goes through the encoder once, however many beam widths are scored
+    encodings = SourceEncodings(encoder, [pair[0] for pair in pairs], src_vocab,
+                                args.decode_batch_size, args.precision)
+    logging.info('encoded %d sentences in %.1fs', len(encodings), time.time() - start)
+    for beam_size in args.beam_sizes or [args.beam_size]:
+        start = time.time()
+        translated = translate_sentences(encoder, decoder, pairs, src_vocab, tgt_vocab,
+                                         beam_size=beam_size,
+                                         length_penalty=args.length_penalty,
+                                         precision=args.precision,
+                                         detokenize=True,
+                                         encodings=encodings)
+        logging.info('BLEU on %s with beam size %d: %.2f (%d sentences, decoded in %.1fs)', args.dev_file,
+                     beam_size, scorer.score(translated, detokenized=True), len(pairs), time.time() - start)
+
+
+def run_plot(args):
+    encoder, decoder, src_vocab, tgt_vocab = load_for_inference(args)
+    plot_attention_examples(encoder, decoder, src_vocab, tgt_vocab, args.sentences or ATTENTION_EXAMPLES,
+                            args.plot_dir, precision=args.precision)
+
+
+COMMANDS = ('train', 'translate', 'nbest', 'score', 'eval', 'plot')
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description='train a model, or translate / evaluate / plot attention with one. '
+                                             'without a command, the arguments are taken as train arguments')
+    sub = ap.add_subparsers(dest='command')
+    sub.required = True
+
+    ap_train = sub.add_parser('train', help='train a model (the default command)')
+    add_train_arguments(ap_train)
+    ap_train.set_defaults(func=run_train)
+
+    ap_translate = sub.add_parser('translate', help='translate a file with a checkpoint or exported model')
+    ap_translate.add_argument('checkpoint',
+                              help='state_*.pt checkpoint, or a model exported by quantize.py')
+    ap_translate.add_argument('--in_file', default='-',
+                              help='source sentences, one per line (or src|||tgt pairs); - for stdin')
+    ap_translate.add_argument('--out_file', default='-',
+                              help='file the translations are written to; - for stdout')
+    add_decode_arguments(ap_translate)
+    ap_translate.set_defaults(func=run_translate)
+
+    ap_nbest = sub.add_parser('nbest', help='n-best lists with per-token log-probs, one JSON line per sentence')
+    ap_nbest.add_argument('checkpoint',
+                          help='state_*.pt checkpoint, or a model exported by quantize.py')
+    ap_nbest.add_argument('--in_file', default='-',
+                          help='source sentences, one per line (or src|||tgt pairs); - for stdin')
+    ap_nbest.add_argument('--out_file', default='-',
+                          help='file the n-best lists are written to; - for stdout')
+    ap_nbest.add_argument('--n_best', default=5, type=int,
+                          help='hypotheses per sentence (the beam is at least this wide)')
+    ap_nbest.add_argument('--detokenize', action='store_true',
+                          help='give the translations as finished sentences instead of BPE')
+    add_decode_arguments(ap_nbest)
+    ap_nbest.set_defaults(func=run_nbest)
+
+    ap_score = sub.add_parser('score', help='log-likelihood of candidate translations (forced decoding), '
+                                            'one JSON line per candidate')
+    ap_score.add_argument('checkpoint',
+                          help='state_*.pt checkpoint, or a model exported by quantize.py')
+    ap_score.add_argument('--in_file', default='-',
+                          help='source|||candidate pairs (BPE\'d), one per line; - for stdin')
+    ap_score.add_argument('--out_file', default='-',
+                          help='file the scores are written to; - for stdout')
+    add_decode_arguments(ap_score)
+    ap_score.set_defaults(func=run_score)
+
+    ap_eval = sub.add_parser('eval', help='BLEU of a checkpoint or exported model')
+    ap_eval.add_argument('checkpoint',
+                         help='state_*.pt checkpoint, or a model exported by quantize.py')
+    ap_eval.add_argument('--dev_file', default='data/fren.dev.bpe',
+                         help='file of src|||tgt pairs to score on')
+    ap_eval.add_argument('--beam_sizes', default=None, type=int, nargs='+',
+                         help='score each of these beam widths (instead of --beam_size), encoding the dev set once')
+    add_decode_arguments(ap_eval)
+    ap_eval.set_defaults(func=run_eval)
+
+    ap_plot = sub.add_parser('plot', help='write attention plots of a checkpoint to PNG files (no display needed)')
+    ap_plot.add_argument('checkpoint',
+                         help='state_*.pt checkpoint, or a model exported by quantize.py')
+    ap_plot.add_argument('sentences', nargs='*',
+                         help='BPE\'d source sentences to plot (default: the examples plotted after training)')
+    ap_plot.add_argument('--plot_dir', default='attention_plots',
+                         help='directory the plots are written to')
+    add_decode_arguments(ap_plot)
+    ap_plot.set_defaults(func=run_plot)
+
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] not in COMMANDS + ('-h', '--help'):
+        argv = ['train'] + argv
+    args = ap.parse_args(argv)
+    args.func(args)
+
+
+def train_worker(rank, args, model_config, train_corpus, src_vocab, tgt_vocab, state=None):
+    """trains the model, starting from the checkpoint state if given.
+    with --workers > 1 this runs in each of the data-parallel worker processes:
+    every worker trains on its own shard of the corpus and gradients are averaged
+    after each backward pass; only rank 0 writes checkpoints, evaluates and translates
+    """
+    world_size = args.workers
+    if args.torchscript:
+        script_lstm()
+    if args.seed is not None:
+        random.seed(args.seed + rank)
+        torch.manual_seed(args.seed + rank)
+    if world_size > 1:
+        torch.set_num_threads(args.threads_per_worker or max(1, (os.cpu_count() or 1) // world_size))
+        dist.init_process_group('gloo', init_method='tcp://127.0.0.1:%d' % args.master_port,
+                                rank=rank, world_size=world_size)
+    elif args.threads_per_worker is not None:
+        torch.set_num_threads(args.threads_per_worker)
+
+    encoder, decoder = make_model(model_config, src_vocab, tgt_vocab)
 
     # encoder/decoder weights are randomly initilized
     # if checkpointed, load saved weights
-    if args.load_checkpoint is not None:
+    # also set iteration 
+    if state is not None:
+        iter_num = state['iter_num']
         encoder.load_state_dict(state['enc_state'])
         decoder.load_state_dict(state['dec_state'])
+    else:
+        iter_num = 0
 
     # read in datafiles
-    train_pairs = split_lines(args.train_file)
     dev_pairs = split_lines(args.dev_file)
     test_pairs = split_lines(args.test_file)
+    train_data = TrainingData(train_corpus, src_vocab, tgt_vocab, args.batch_size, args.bucket_width,
+                              rank=rank, world_size=world_size, max_tokens=args.max_tokens)
+    train_batches = iter(train_data)
 
     # set up optimization/loss
     params = list(encoder.parameters()) + list(decoder.parameters())  # .parameters() returns generator
-    optimizer = optim.Adam(params, lr=args.initial_learning_rate)
-    criterion = nn.NLLLoss()
+    if world_size > 1:
+        broadcast_parameters(params)
+    mean_batch_size = train_data.mean_batch_size()
+    if world_size > 1:
+        # the shards batch differently under --max_tokens, and every worker has to step with the same learning rate
+        mean_batch_size = mean_over_workers(mean_batch_size)
+    effective_batch = mean_batch_size * args.accumulate_steps * world_size
+    learning_rate = scaled_learning_rate(args.initial_learning_rate, effective_batch / args.lr_reference_batch,
+                                         args.lr_scaling)
+    if rank == 0:
+        logging.info('effective batch: %.1f sentences per update, learning rate %g', effective_batch, learning_rate)
+    optimizer = optim.Adam(params, lr=learning_rate)
 
     # optimizer may have state
     # if checkpointed, load saved state
-    if args.load_checkpoint is not None:
+    if state is not None:
         optimizer.load_state_dict(state['opt_state'])
 
+    if rank == 0:
+        vocab_file, fingerprint = save_vocabs(src_vocab, tgt_vocab)
+        checkpoint_writer = CheckpointWriter(args.keep_checkpoints)
+        translation_cache = None
+        if args.translation_cache_mb > 0:
+            translation_cache = TranslationCache(int(args.translation_cache_mb * 2 ** 20), args.translation_cache_file)
+        if args.foreground_eval:
+            dev_evaluator = None
+            dev_scorer = BleuScorer([pair[1] for pair in dev_pairs])
+        else:
+            dev_evaluator = DevEvaluator(args, model_config, src_vocab, tgt_vocab, dev_pairs)
+
+    metrics_file, profile_file = args.metrics_file, args.profile_file
+    if world_size > 1:
+        metrics_file = metrics_file and '%s.rank%d' % (metrics_file, rank)
+        profile_file = '%s.rank%d' % (profile_file, rank)
+    metrics = TrainingMetrics(metrics_file, rank=rank, profile_iters=args.profile_iters, profile_file=profile_file)
+
     start = time.time()
     print_loss_total = 0  # Reset every args.print_every
+    print_start = time.time()
+    print_sentences = 0
 
     while iter_num < args.n_iters:
         iter_num += 1
-        input_batches, input_lengths, target_batches, target_lengths = mini_batch(8, train_pairs, args.src_lang, args.tgt_lang)
-        loss = train(input_batches, input_lengths, target_batches, target_lengths, encoder, decoder, optimizer,criterion,batch_size=8)
+        metrics.step(iter_num)
+        step_start = time.perf_counter()
+        with metrics.phase('data'):
+            batches = [next(train_batches) for _ in range(args.accumulate_steps)]
+        for batch in batches:
+            metrics.count_batch(*batch)
+        loss = train_update(batches, encoder, decoder, optimizer,
+                            teacher_force_ratio=args.teacher_force_ratio, metrics=metrics, precision=args.precision)
+        metrics.count_update(time.perf_counter() - step_start)
         print_loss_total += loss
-
-        if iter_num % args.checkpoint_every == 0:
-            state = {'iter_num': iter_num,
-                     'enc_state': encoder.state_dict(),
-                     'dec_state': decoder.state_dict(),
-                     'opt_state': optimizer.state_dict(),
-                     'src_vocab': src_vocab,
-                     'tgt_vocab': tgt_vocab,
-                     }
-            filename = 'state_%010d.pt' % iter_num
-            torch.save(state, filename)
-            logging.debug('wrote checkpoint to %s', filename)
+        print_sentences += sum(len(batch[1]) for batch in batches)
+
+        if iter_num % args.checkpoint_every == 0 and rank == 0:
+            with metrics.phase('checkpoint'):
+                state = {'iter_num': iter_num,
+                         'enc_state': encoder.state_dict(),
+                         'dec_state': decoder.state_dict(),
+                         'opt_state': optimizer.state_dict(),
+                         'vocab_file': vocab_file,
+                         'vocab_fingerprint': fingerprint,
+                         'model_config': model_config,
+                         }
+                filename = 'state_%010d.pt' % iter_num
+                checkpoint_writer.save(state, filename)
 
         if iter_num % args.print_every == 0:
+            sentences_per_sec = print_sentences / (time.time() - print_start)
             print_loss_avg = print_loss_total / args.print_every
             print_loss_total = 0
+            if world_size > 1:
+                with metrics.phase('allreduce'):
+                    worker_rates = gather_throughput(sentences_per_sec)
+            if rank != 0:
+                metrics.flush(iter_num, loss_avg=print_loss_avg)
+                print_start = time.time()
+                print_sentences = 0
+                continue
+
             logging.info('time since start:%s (iter:%d iter/n_iters:%d%%) loss_avg:%.4f',
                          time.time() - start,
                          iter_num,
                          iter_num / args.n_iters * 100,
                          print_loss_avg)
+            if world_size > 1:
+                logging.info('sentences/sec per worker: %s (total %.1f)',
+                             ' '.join('%.1f' % rate for rate in worker_rates), sum(worker_rates))
+            else:
+                logging.info('sentences/sec: %.1f', sentences_per_sec)
             # translate from the dev set
-            translate_random_sentence(encoder, decoder, dev_pairs, target_lengths, batch_size, src_vocab, tgt_vocab, n=2)
-            translated_sentences = translate_sentences(encoder, decoder, dev_pairs, target_lengths, batch_size, src_vocab, tgt_vocab)
-
-            references = [[clean(pair[1]).split(), ] for pair in dev_pairs[:len(translated_sentences)]]
-            candidates = [clean(sent).split() for sent in translated_sentences]
-            dev_bleu = corpus_bleu(references, candidates)
-            logging.info('Dev BLEU score: %.2f', dev_bleu)
+            with metrics.phase('samples'):
+                translate_random_sentence(encoder, decoder, dev_pairs, src_vocab, tgt_vocab, n=2,
+                                          cache=translation_cache, precision=args.precision)
+            dev_bleu = None
+            with metrics.phase('dev_eval'):
+                if dev_evaluator is not None:
+                    dev_evaluator.submit(iter_num, encoder, decoder)
+                else:
+                    translated_sentences = translate_sentences(encoder, decoder, dev_pairs, src_vocab, tgt_vocab,
+                                                               batch_size=args.decode_batch_size,
+                                                               beam_size=args.beam_size,
+                                                               length_penalty=args.length_penalty,
+                                                               cache=translation_cache,
+                                                               precision=args.precision,
+                                                               detokenize=True)
+                    dev_bleu = dev_scorer.score(translated_sentences, detokenized=True)
+                    logging.info('Dev BLEU score: %.2f', dev_bleu)
+            # this interval's metrics include the dev evaluation above
+            metrics.flush(iter_num, loss_avg=print_loss_avg, dev_bleu=dev_bleu)
+            print_start = time.time()
+            print_sentences = 0
+
+    metrics.close()
+    if world_size > 1:
+        dist.destroy_process_group()
+    if rank != 0:
+        return
+    checkpoint_writer.close()
+    if dev_evaluator is not None:
+        dev_evaluator.close()
 
     # translate test set and write to file
-    translated_sentences = translate_sentences(encoder, decoder, test_pairs, target_lengths, batch_size, src_vocab, tgt_vocab)
-    with open(args.out_file, 'wt', encoding='utf-8') as outf:
-        for sent in translated_sentences:
-            outf.write(clean(sent) + '\n')
+    translated_sentences = translate_sentences(encoder, decoder, test_pairs, src_vocab, tgt_vocab,
+                                               batch_size=args.decode_batch_size,
+                                               beam_size=args.beam_size,
+                                               length_penalty=args.length_penalty,
+                                               cache=translation_cache,
+                                               precision=args.precision,
+                                               detokenize=True)
+    write_lines(args.out_file, translated_sentences)
 
     # Visualizing Attention
-    translate_and_show_attention("on p@@ eu@@ t me faire confiance .", encoder, decoder, src_vocab, tgt_vocab)
-    translate_and_show_attention("j en suis contente .", encoder, decoder, src_vocab, tgt_vocab)
-    translate_and_show_attention("vous etes tres genti@@ ls .", encoder, decoder, src_vocab, tgt_vocab)
-    translate_and_show_attention("c est mon hero@@ s ", encoder, decoder, src_vocab, tgt_vocab)
+    if args.plot_dir:
+        plot_attention_examples(encoder, decoder, src_vocab, tgt_vocab, ATTENTION_EXAMPLES, args.plot_dir,
+                                cache=translation_cache, precision=args.precision)
+
+    if translation_cache is not None:
+        logging.info('translation cache: %s', translation_cache.stats())
+        translation_cache.save()
 
 
 if __name__ == '__main__':
     main()
-    
-
-    
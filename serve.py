@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Translation with a trained checkpoint, without going through training.
+
+Streaming batch CLI (one source sentence per line in, one translation per line out):
+
+    python serve.py state_0000100000.pt < input.txt > output.txt
+
+Instead of a checkpoint, a model exported by quantize.py can be given.
+
+Local HTTP server:
+
+    python serve.py state_0000100000.pt --port 8000
+
+    POST /translate  {"sentences": ["...", ...]}  ->  {"translations": ["...", ...]}
+    GET  /metrics    latency percentiles and throughput counters
+
+Sentences from concurrent requests (or consecutive input lines) are gathered
+into micro-batches, which are translated once they are full or the oldest
+sentence in them has waited --max_wait_ms.
+"""
+
+
+from __future__ import unicode_literals, print_function, division
+
+import argparse
+import collections
+import json
+import logging
+import queue
+import socketserver
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import torch
+
+import seq2seq
+
+
+class Translator:
+    """ A checkpoint (or a model exported by quantize.py) loaded once, in eval mode, for inference
+    """
+    def __init__(self, checkpoint, batch_size=64, beam_size=1, length_penalty=1.0, torchscript=False, cache=None,
+                 precision='fp32'):
+        self.encoder, self.decoder, self.src_vocab, self.tgt_vocab = seq2seq.load_model(checkpoint)
+        if torchscript:
+            # only the LSTM time loop: decoding drives the encoder and decoder from python
+            # (AttentionMemory, beam search), so the modules themselves stay eager
+            seq2seq.script_lstm()
+        self.batch_size = batch_size
+        self.beam_size = beam_size
+        self.length_penalty = length_penalty
+        self.cache = cache
+        self.precision = precision
+        logging.info('loaded %s', checkpoint)
+
+    def translate(self, sentences):
+        """translates a list of source sentences (BPE'd, space separated) into cleaned target sentences
+        """
+        with torch.inference_mode():
+            return seq2seq.translate_sentences(self.encoder, self.decoder,
+                                               [[sentence] for sentence in sentences],
+                                               self.src_vocab, self.tgt_vocab,
+                                               batch_size=self.batch_size,
+                                               beam_size=self.beam_size,
+                                               length_penalty=self.length_penalty,
+                                               cache=self.cache,
+                                               precision=self.precision,
+                                               detokenize=True)
+
+
+######################################################################
+
+class ServingMetrics:
+    """ Request latencies (over a sliding window) and throughput counters,
+    plus the hit rate of the translation cache if there is one
+    """
+    def __init__(self, window=10000, cache=None):
+        self.cache = cache
+        self._lock = threading.Lock()
+        self._latencies = collections.deque(maxlen=window)
+        self.start = time.monotonic()
+        self.requests = 0
+        self.sentences = 0
+        self.batches = 0
+
+    def record_batch(self, n_sentences):
+        with self._lock:
+            self.batches += 1
+            self.sentences += n_sentences
+
+    def record_request(self, latency):
+        with self._lock:
+            self.requests += 1
+            self._latencies.append(latency)
+
+    def snapshot(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+            uptime = time.monotonic() - self.start
+            snapshot = {'requests': self.requests,
+                        'sentences': self.sentences,
+                        'batches': self.batches,
+                        'mean_batch_size': self.sentences / self.batches if self.batches else 0.0,
+                        'latency_p50_ms': percentile(latencies, 0.50) * 1e3,
+                        'latency_p99_ms': percentile(latencies, 0.99) * 1e3,
+                        'requests_per_sec': self.requests / uptime,
+                        'sentences_per_sec': self.sentences / uptime,
+                        }
+        if self.cache is not None:
+            snapshot.update(self.cache.stats())
+        return snapshot
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[int(round(q * (len(sorted_values) - 1)))]
+
+
+class _Request:
+    def __init__(self, sentences):
+        self.sentences = sentences
+        self.arrival = time.monotonic()
+        self.done = threading.Event()
+        self.translations = None
+        self.error = None
+
+    def result(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.translations
+
+
+class MicroBatcher:
+    """ Gathers the sentences of concurrent requests into micro-batches for one Translator.
+    A batch is translated as soon as it holds max_batch_size sentences or its oldest
+    request has waited max_wait seconds, whichever comes first.
+    """
+    def __init__(self, translator, max_batch_size, max_wait, metrics):
+        self.translator = translator
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.metrics = metrics
+        self._pending = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+        self._thread.start()
+
+    def submit(self, sentences):
+        """queues sentences for translation; call .result() on the returned request to wait for them
+        """
+        request = _Request(sentences)
+        self._pending.put(request)
+        return request
+
+    def translate(self, sentences):
+        return self.submit(sentences).result()
+
+    def _next_batch(self):
+        batch = [self._pending.get()]
+        n_sentences = len(batch[0].sentences)
+        deadline = batch[0].arrival + self.max_wait
+        while n_sentences < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self._pending.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(request)
+            n_sentences += len(request.sentences)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            sentences = [sentence for request in batch for sentence in request.sentences]
+            try:
+                translations = self.translator.translate(sentences)
+            except Exception as e:
+                logging.exception('translating a batch of %d sentences failed', len(sentences))
+                translations = None
+                for request in batch:
+                    request.error = e
+            self.metrics.record_batch(len(sentences))
+
+            offset = 0
+            now = time.monotonic()
+            for request in batch:
+                if translations is not None:
+                    request.translations = translations[offset:offset + len(request.sentences)]
+                    offset += len(request.sentences)
+                self.metrics.record_request(now - request.arrival)
+                request.done.set()
+
+
+######################################################################
+
+def run_cli(batcher, metrics, infile, outfile):
+    """translates infile line by line, writing the translations to outfile in input order.
+    lines are fed to the batcher as they are read, so this also works on a live pipe
+    """
+    requests = queue.Queue()
+
+    def write_results():
+        while True:
+            request = requests.get()
+            if request is None:
+                return
+            try:
+                translation = request.result()[0]
+            except Exception:
+                # already logged by the batcher; keep the output aligned with the input
+                translation = ''
+            outfile.write(translation + '\n')
+            if requests.empty():
+                outfile.flush()
+
+    writer = threading.Thread(target=write_results, name='cli-writer')
+    writer.start()
+    for line in infile:
+        requests.put(batcher.submit([line.rstrip('\n')]))
+    requests.put(None)
+    writer.join()
+    outfile.flush()
+    logging.info('metrics: %s', json.dumps(metrics.snapshot()))
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    """an HTTPServer handling each request on its own thread (http.server only has one from python 3.7)
+    """
+    daemon_threads = True
+
+
+def make_handler(batcher, metrics):
+    class TranslationHandler(BaseHTTPRequestHandler):
+        def _send_json(self, status, obj):
+            body = json.dumps(obj).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/metrics':
+                self._send_json(200, metrics.snapshot())
+            else:
+                self._send_json(404, {'error': 'unknown path %s' % self.path})
+
+        def do_POST(self):
+            if self.path != '/translate':
+                self._send_json(404, {'error': 'unknown path %s' % self.path})
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                sentences = request['sentences']
+            except (ValueError, KeyError, TypeError):
+                sentences = None
+            # checked here, since a bad sentence would fail everyone else's requests in its micro-batch
+            if not isinstance(sentences, list) or not sentences or not all(isinstance(s, str) for s in sentences):
+                self._send_json(400, {'error': 'expected a JSON body like {"sentences": ["..."]} '
+                                               'with a non-empty list of strings'})
+                return
+            try:
+                self._send_json(200, {'translations': batcher.translate(sentences)})
+            except Exception as e:
+                self._send_json(500, {'error': str(e)})
+
+        def log_message(self, format, *args):
+            logging.debug('%s - ' + format, self.address_string(), *args)
+
+    return TranslationHandler
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('checkpoint',
+                    help='state_*.pt checkpoint, or a model exported by quantize.py, to translate with')
+    ap.add_argument('--port', default=None, type=int,
+                    help='serve HTTP on this port instead of translating stdin to stdout')
+    ap.add_argument('--host', default='127.0.0.1',
+                    help='address the HTTP server binds to')
+    ap.add_argument('--max_batch_size', default=64, type=int,
+                    help='largest micro-batch, in sentences')
+    ap.add_argument('--max_wait_ms', default=10.0, type=float,
+                    help='longest a sentence waits for its micro-batch to fill up')
+    ap.add_argument('--beam_size', default=1, type=int,
+                    help='beam width (1 means greedy decoding)')
+    ap.add_argument('--length_penalty', default=1.0, type=float,
+                    help='beam search ranks finished hypotheses by log_prob / length ** length_penalty')
+    ap.add_argument('--torchscript', action='store_true',
+                    help='run the LSTM time loop TorchScript-compiled')
+    ap.add_argument('--threads', default=None, type=int,
+                    help='intra-op threads')
+    ap.add_argument('--precision', default='fp32', choices=seq2seq.PRECISIONS,
+                    help='bf16 runs the model under CPU autocast')
+    ap.add_argument('--cache_mb', default=64, type=float,
+                    help='memory bound of the translation cache (0 disables it)')
+    ap.add_argument('--cache_file', default=None,
+                    help='file the translation cache is loaded from at startup and saved to on exit')
+    args = ap.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    cache = None
+    if args.cache_mb > 0:
+        cache = seq2seq.TranslationCache(int(args.cache_mb * 2 ** 20), args.cache_file)
+    translator = Translator(args.checkpoint,
+                            batch_size=args.max_batch_size,
+                            beam_size=args.beam_size,
+                            length_penalty=args.length_penalty,
+                            torchscript=args.torchscript,
+                            cache=cache,
+                            precision=args.precision)
+    metrics = ServingMetrics(cache=cache)
+    batcher = MicroBatcher(translator, args.max_batch_size, args.max_wait_ms / 1e3, metrics)
+
+    if args.port is None:
+        run_cli(batcher, metrics, sys.stdin, sys.stdout)
+        if cache is not None:
+            cache.save()
+        return
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(batcher, metrics))
+    logging.info('serving translations on http://%s:%d/translate', args.host, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        logging.info('metrics: %s', json.dumps(metrics.snapshot()))
+        if cache is not None:
+            cache.save()
+
+
+if __name__ == '__main__':
+    main()